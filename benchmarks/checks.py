@@ -0,0 +1,216 @@
+"""
+Checks behaviour of the job-generator parts that talk to external services and tools
+against local stubs: HTTP server with Range support, Airflow REST API server, fake fastq-dump and docker.
+
+    python benchmarks/checks.py [--case trigger_rest]
+"""
+
+import os
+import sys
+import gzip
+import shutil
+import hashlib
+import argparse
+import tempfile
+from argparse import Namespace
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.server import start_server, start_airflow_stub
+
+
+FAKE_FASTQ_DUMP = os.path.join(ROOT, "benchmarks", "fake_fastq_dump.py")
+FAKE_FASTQ_DUMP_LOG_ENV = "FAKE_FASTQ_DUMP_LOG"
+FAKE_DOCKER = os.path.join(ROOT, "benchmarks", "fake_docker.py")
+FAKE_DOCKER_LOG_ENV = "FAKE_DOCKER_LOG"
+
+
+def check_download_cache(workdir):
+    from job_generator.utils.download import fetch_file, get_cached_filepath
+    data_folder, cache_folder = os.path.join(workdir, "data"), os.path.join(workdir, "cache")
+    os.makedirs(data_folder)
+    data = os.urandom(300000)
+    md5sum = hashlib.md5(data).hexdigest()
+    with open(os.path.join(data_folder, "F1.fastq.gz"), "wb") as output_stream:
+        output_stream.write(data)
+    server, url = start_server(data_folder)
+    file_url = f"""{url}/F1.fastq.gz"""
+    try:
+        for accession, part_size in [("resumed", 1000), ("complete", len(data))]:
+            filepath = get_cached_filepath(cache_folder, file_url, accession, md5sum)
+            with open(filepath + ".part", "wb") as output_stream:            # left by the interrupted transfer
+                output_stream.write(data[:part_size])
+            fetch_file(file_url, filepath, md5sum)
+            with open(filepath, "rb") as input_stream:
+                assert input_stream.read() == data, f"""{accession} file doesn't match the served one"""
+            assert server.requests[-1]["range"] == f"""bytes={part_size}-""", f"""{accession} file is not resumed: {server.requests[-1]}"""
+            assert not os.path.exists(filepath + ".part"), f"""partial {accession} file is left"""
+        requests = len(server.requests)
+        fetch_file(file_url, filepath, md5sum)
+        assert len(server.requests) == requests, "cached file is downloaded again"
+        filepath = get_cached_filepath(cache_folder, file_url, "broken", "0" * 32)
+        try:
+            fetch_file(file_url, filepath, "0" * 32)
+            failed = False
+        except Exception:
+            failed = True
+        assert failed, "md5sum mismatch is not reported"
+        assert not os.path.exists(filepath) and not os.path.exists(filepath + ".part"), "file with wrong md5sum is left"
+    finally:
+        server.shutdown()
+
+
+def check_trigger_rest(workdir):
+    from job_generator.utils.airflow import trigger_dags, AIRFLOW_USERNAME_ENV, AIRFLOW_PASSWORD_ENV
+    server, url = start_airflow_stub()
+    os.environ.update({AIRFLOW_USERNAME_ENV: "admin", AIRFLOW_PASSWORD_ENV: "secret"})
+    try:
+        failed = trigger_dags([("run_ok", {"a": 1}), ("run_flaky", {"b": 2}), ("run_conflict", {})], "atac dag", "rest", url)
+    finally:
+        server.shutdown()
+        for key in [AIRFLOW_USERNAME_ENV, AIRFLOW_PASSWORD_ENV]:
+            os.environ.pop(key)
+    assert set(failed) == {"run_conflict"}, f"""unexpected failed runs {failed}"""
+    assert "HTTP 409" in str(failed["run_conflict"]), f"""409 is not reported: {failed["run_conflict"]}"""
+    run_ids = [request["data"]["dag_run_id"] for request in server.requests]
+    assert run_ids == ["run_ok", "run_flaky", "run_flaky", "run_conflict"], f"""503 is not retried once: {run_ids}"""
+    assert all(request["path"] == "/api/v1/dags/atac%20dag/dagRuns" for request in server.requests), "wrong endpoint"
+    assert all(request["headers"].get("Authorization", "").startswith("Basic ") for request in server.requests), "no credentials"
+    assert server.requests[0]["data"]["conf"] == {"a": 1}, "job is not passed as conf"
+
+
+def check_trigger_batch(workdir):
+    from job_generator import submit_max_atac_job as submit
+    from job_generator.utils.pipeline import run_pipeline
+    from job_generator.utils import metrics
+    server, url = start_airflow_stub()
+    calls = []
+    trigger_jobs = submit.trigger_jobs
+    submit.trigger_jobs = lambda jobs, *args: calls.append(len(jobs)) or trigger_jobs(jobs, *args)
+    args = Namespace(
+        state=None, suffix="_s", download=False, dag="dag", trigger_backend="rest", airflow_url=url, trigger_folder=None,
+        indices="indices", blacklisted="blacklisted.bed", genome="genome.fa", output="output", threads=1
+    )
+    experiments = [
+        {"exp_idx": (exp_id, 1), "first_combined": "R1.fastq.gz", "second_combined": "R2.fastq.gz"}
+        for exp_id in ["E1", "E2_conflict", "E3"]
+    ]
+    try:
+        results = submit.run_batch_stage(args, "trigger", submit.trigger_experiments, experiments)
+    finally:
+        submit.trigger_jobs = trigger_jobs
+        server.shutdown()
+    assert calls == [3], f"""experiments are not triggered in one batch: {calls}"""
+    assert [isinstance(result, Exception) for result in results] == [False, True, False], f"""wrong results {results}"""
+    assert [request["data"]["dag_run_id"] for request in server.requests] == ["E1_1_s", "E2_conflict_1_s", "E3_1_s"]
+    report = metrics.get_report()["experiments"]
+    triggers = [report.get(run_id, {}).get("trigger_dag", {}) for run_id in ["E1_1", "E2_conflict_1", "E3_1"]]
+    assert [entry.get("failures") for entry in triggers] == [0, 1, 0], f"""wrong trigger failures per experiment {triggers}"""
+    assert all(entry["seconds"] > 0 for entry in triggers), "trigger time is not counted per experiment"
+
+    batches = []
+    results, failed = run_pipeline(range(50), [
+        ("double", lambda item: item * 2, 2),
+        ("batch", lambda items: batches.append(len(items)) or [ValueError(item) if item == 10 else item for item in items], 1, 8)
+    ])
+    assert sorted(results) == [item * 2 for item in range(50) if item != 5], "batch stage lost or duplicated items"
+    assert [(item, stage) for item, stage, _ in failed] == [(10, "batch")], f"""wrong failures {failed}"""
+    assert max(batches) <= 8 and sum(batches) == 50, f"""wrong batches {batches}"""
+
+
+def get_read_names(filepath):
+    with gzip.open(filepath, "rt") as input_stream:
+        return [line.split()[0][1:] for index, line in enumerate(input_stream) if index % 4 == 0]
+
+
+def get_max_running(log):
+    """Returns the max number of fake fastq-dump runs that were running at the same time"""
+    with open(log, "r") as input_stream:
+        events = sorted((float(moment), 1 if event == "start" else -1) for event, _, moment in map(str.split, input_stream))
+    running = max_running = 0
+    for _, change in events:
+        running += change
+        max_running = max(max_running, running)
+    return max_running
+
+
+def check_extract_sra(workdir):
+    from job_generator import submit_max_atac_job as submit
+    fasterq_dump = os.path.join(workdir, "fasterq-dump")                 # can't gzip, output is compressed on append
+    os.symlink(FAKE_FASTQ_DUMP, fasterq_dump)
+    bin_folder = tempfile.mkdtemp()
+    os.symlink(FAKE_DOCKER, os.path.join(bin_folder, "docker"))
+    log, docker_log = os.path.join(workdir, "fake_fastq_dump.log"), os.path.join(workdir, "fake_docker.log")
+    cwd, submit.CWD = submit.CWD, workdir
+    path = os.environ["PATH"]
+    os.environ.update({FAKE_FASTQ_DUMP_LOG_ENV: log, FAKE_DOCKER_LOG_ENV: docker_log, "PATH": bin_folder + os.pathsep + path})
+    srr_files = ["SRR3", "SRR2", "SRR1"]                                   # the first one finishes last
+    try:
+        for fdump in [FAKE_FASTQ_DUMP, fasterq_dump, None]:                # None runs fastq-dump in docker
+            combined = submit.extract_sra(
+                srr_files, os.path.basename(fdump or "docker"), fdump, False, False, jobs=3, threads=2, compress_threads=2
+            )
+            for filepath in combined:
+                assert get_read_names(filepath) == [f"""{srr_id}.{read}""" for srr_id in srr_files for read in range(100)], \
+                    f"""runs are not appended in order of SRR list in {filepath}"""
+        assert get_max_running(log) > 1, "runs are not extracted in parallel"
+        with open(docker_log, "r") as input_stream:
+            commands = [line.split()[0] for line in input_stream]
+        assert commands == ["run"] + ["exec"] * len(srr_files) + ["rm"], f"""runs are not extracted in one container: {commands}"""
+        try:
+            submit.extract_sra(["SRR1", "SRR_FAIL"], "failed", FAKE_FASTQ_DUMP, False, False, jobs=2)
+            failed = False
+        except Exception:
+            failed = True
+        assert failed, "failed run is not reported"
+        assert not any(os.path.exists(os.path.join(workdir, f"""failed_R{mate}.fastq.gz""")) for mate in [1, 2]), \
+            "combined files of the failed experiment are left"
+        folders = [name for name in os.listdir(workdir) if os.path.isdir(os.path.join(workdir, name))]
+        assert not folders, f"""temporary folders are left: {folders}"""
+    finally:
+        submit.CWD = cwd
+        os.environ["PATH"] = path
+        for key in [FAKE_FASTQ_DUMP_LOG_ENV, FAKE_DOCKER_LOG_ENV]:
+            os.environ.pop(key)
+        shutil.rmtree(bin_folder)
+
+
+CASES = {
+    "download_cache": check_download_cache,
+    "trigger_rest": check_trigger_rest,
+    "trigger_batch": check_trigger_batch,
+    "extract_sra": check_extract_sra
+}
+
+
+def arg_parser():
+    general_parser = argparse.ArgumentParser()
+    general_parser.add_argument("-c", "--case", help="Run only selected cases. Default: all", nargs="+")
+    return general_parser
+
+
+def main(argsl=None):
+    if argsl is None:
+        argsl = sys.argv[1:]
+    args,_ = arg_parser().parse_known_args(argsl)
+    failed = []
+    for case in args.case or CASES:
+        with tempfile.TemporaryDirectory() as workdir:
+            try:
+                with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                    CASES[case](workdir)
+            except ImportError as err:
+                print(f"""SKIP  {case:24}  {err}""")
+                continue
+            except Exception as err:                                       # assertion or unexpected error
+                failed.append(case)
+                print(f"""FAIL  {case:24}  {err if isinstance(err, AssertionError) else repr(err)}""")
+                continue
+        print(f"""OK    {case:24}""")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Fake docker for SRA extraction. "run -v folder:/tmp/ ..." prints folder as container id, "exec id fastq-dump ..."
+runs fake_fastq_dump.py with /tmp/ replaced by the mounted folder, "rm" does nothing. Logs commands to $FAKE_DOCKER_LOG
+"""
+
+import os
+import sys
+import subprocess
+
+
+FAKE_FASTQ_DUMP = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fake_fastq_dump.py")
+
+
+def main(argsl=None):
+    command, container = argsl[0], argsl[-1]
+    if command == "run":
+        container = argsl[argsl.index("-v") + 1].rsplit(":/tmp/", 1)[0]
+        print(container)
+    elif command == "exec":
+        container = argsl[1]
+    log = os.environ.get("FAKE_DOCKER_LOG")
+    if log:
+        with open(log, "a") as log_stream:
+            log_stream.write(f"""{command} {container}\n""")
+    if command == "exec":
+        params = [container + "/" + param[len("/tmp/"):] if param.startswith("/tmp/") else param for param in argsl[3:]]
+        return subprocess.call([sys.executable, FAKE_FASTQ_DUMP] + params)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Fake fastq-dump/fasterq-dump. Writes SRR_1 and SRR_2 mates with reads named after SRR to --outdir,
+gzipped with --gzip. Sleeps SRR number / 10 seconds, so the earlier runs may finish later when the
+numbers go down. Fails if SRR contains FAIL. Logs start and end of each run to $FAKE_FASTQ_DUMP_LOG
+"""
+
+import os
+import re
+import sys
+import gzip
+import time
+import argparse
+
+
+def main(argsl=None):
+    general_parser = argparse.ArgumentParser()
+    general_parser.add_argument("srr_id")
+    general_parser.add_argument("--split-3", action="store_true")
+    general_parser.add_argument("--gzip",    action="store_true")
+    general_parser.add_argument("--threads", type=int)
+    general_parser.add_argument("--outdir",  default=".")
+    args = general_parser.parse_args(argsl)
+    log = os.environ.get("FAKE_FASTQ_DUMP_LOG")
+    if log:
+        with open(log, "a") as log_stream:
+            log_stream.write(f"""start {args.srr_id} {time.monotonic()}\n""")
+    time.sleep(int(re.sub(r"""\D""", "", args.srr_id) or 0) / 10)
+    if "FAIL" in args.srr_id:
+        return 1
+    for mate in [1, 2]:
+        filepath = os.path.join(args.outdir, f"""{args.srr_id}_{mate}.fastq""" + (".gz" if args.gzip else ""))
+        with (gzip.open if args.gzip else open)(filepath, "wb") as output_stream:
+            output_stream.write(b"".join(f"""@{args.srr_id}.{read} {read}/{mate}\nACGT\n+\nIIII\n""".encode() for read in range(100)))
+    if log:
+        with open(log, "a") as log_stream:
+            log_stream.write(f"""end {args.srr_id} {time.monotonic()}\n""")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,245 @@
+"""
+Measures throughput and peak Python memory of the job-generator hot paths on synthetic data
+and compares them with the stored baseline.
+
+    python benchmarks/run.py [--case get_reads_count] [--scale 1.0] [--tolerance 0.3] [--io-tolerance 0.5] [--update]
+"""
+
+import os
+import sys
+import time
+import platform
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from json import dumps, load
+from statistics import median
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import make_fastq, make_encode_metadata, make_salmon_metadata, make_tree
+from benchmarks.server import start_server
+
+
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+IO_CASES = ["download_files", "get_files", "get_files_cached"]          # bound by disk and network, noisy
+IO_REPEAT = 7                                                          # min number of runs to take median from
+
+
+class SkipCase(Exception):
+    """Raised by the case that can't be measured on this host"""
+
+
+def arg_parser():
+    general_parser = argparse.ArgumentParser()
+    general_parser.add_argument("-c", "--case",      help="Run only selected cases. Default: all",                 nargs="+")
+    general_parser.add_argument("-s", "--scale",     help="Multiply synthetic data sizes. Default: 1.0",           type=float, default=1.0)
+    general_parser.add_argument("-r", "--repeat",    help="Number of runs per case, the best one is used (median for I/O-bound cases). Default: 3", type=int, default=3)
+    general_parser.add_argument("-t", "--tolerance", help="Allowed relative regression. Default: 0.3",            type=float, default=0.3)
+    general_parser.add_argument("--io-tolerance",    help="Allowed relative regression of I/O-bound cases. Default: 0.5", type=float, default=0.5)
+    general_parser.add_argument("-b", "--baseline",  help="Path to baseline file. Default: benchmarks/baseline.json", default=BASELINE)
+    general_parser.add_argument("-u", "--update",    help="Save results as a new baseline",                        action="store_true")
+    return general_parser
+
+
+def clear_reads_cache(filepath):
+    from job_generator.utils.fastq import READS_CACHE_FILENAME
+    cache_filepath = os.path.join(os.path.dirname(filepath), READS_CACHE_FILENAME)
+    if os.path.isfile(cache_filepath):
+        os.remove(cache_filepath)
+
+
+def bench_get_reads_count(workdir, scale, threads=1):
+    from job_generator.utils.fastq import get_reads_count
+    reads = int(400000 * scale)
+    filepath = os.path.join(workdir, "count.fastq.gz")
+    if not os.path.isfile(filepath):
+        make_fastq(filepath, reads, members=8)
+
+    def run():
+        clear_reads_cache(filepath)
+        assert get_reads_count(filepath, threads) == reads
+    return run, reads, "reads"
+
+
+def bench_get_reads_count_threads(workdir, scale):
+    if (os.cpu_count() or 1) < 2:
+        raise SkipCase("needs at least 2 CPUs")
+    return bench_get_reads_count(workdir, scale, threads=4)
+
+
+def bench_download_files(workdir, scale):
+    import pandas as pd
+    import job_generator.submit_max_atac_job as submit
+    reads = int(200000 * scale)
+    data_folder = os.path.join(workdir, "http")
+    os.makedirs(data_folder, exist_ok=True)
+    for name in ["first", "second"]:
+        make_fastq(os.path.join(data_folder, name + ".fastq.gz"), reads)
+    server, url = start_server(data_folder)
+    files_df = pd.DataFrame({
+        "File download URL": [f"""{url}/first.fastq.gz""", f"""{url}/second.fastq.gz"""],
+        "File accession": ["first", "second"]
+    })
+    submit.CWD = os.path.join(workdir, "download")
+
+    def run():
+        shutil.rmtree(submit.CWD, ignore_errors=True)
+        os.makedirs(submit.CWD)
+        submit.download_files(files_df, "combined", False, int(reads * 1.5))
+    return run, int(reads * 1.5), "reads"
+
+
+def bench_generate_jobs(workdir, scale):
+    from argparse import Namespace
+    from job_generator.get_salmon_deseq_job import generate_jobs, get_metadata
+    samples = int(10000 * scale)
+    filelist = {}
+    for sample in range(int(25000 * scale)):
+        for mate in [1, 2]:
+            filename = f"""SRR{sample:08d}_{mate}.fastq.gz"""
+            filelist[filename] = os.path.join("/data", filename)
+    metadata = get_metadata(make_salmon_metadata(os.path.join(workdir, "salmon.tsv"), samples))
+    args = Namespace(indices="/indices", transform="/transform", uid="benchmark", threads=1,
+                     workflow="/workflow", output="/output", regex=False, verbose=False)
+
+    def run():
+        assert len(generate_jobs(args, metadata, filelist)["category"]) == samples
+    return run, samples, "samples"
+
+
+def bench_get_files(workdir, scale, cache=False):
+    from job_generator.utils.utils import get_files
+    root = os.path.join(workdir, "tree")
+    if not os.path.isdir(root):
+        make_tree(root, int(500 * scale), 40)
+    cache_folder = os.path.join(workdir, "cache") if cache else None
+    files = len(get_files(root, ".*fastq.*", cache_folder=cache_folder)[0])       # warms up cache and OS
+
+    def run():
+        assert len(get_files(root, ".*fastq.*", cache_folder=cache_folder)[0]) == files
+    return run, files, "files"
+
+
+def bench_get_files_cached(workdir, scale):
+    return bench_get_files(workdir, scale, cache=True)
+
+
+def bench_get_metadata(workdir, scale):
+    from job_generator.submit_max_atac_job import get_metadata
+    experiments = int(20000 * scale)
+    metadata_file = make_encode_metadata(os.path.join(workdir, "encode.tsv"), experiments)
+
+    def run():
+        get_metadata(metadata_file)
+    return run, experiments * 9, "rows"
+
+
+def bench_pairing(workdir, scale):
+    from job_generator.submit_max_atac_job import get_metadata, EXP_COLUMNS
+    from job_generator.utils.pairing import get_work_plan, iter_pairs
+    experiments = int(5000 * scale)
+    metadata = get_metadata(make_encode_metadata(os.path.join(workdir, "pairing.tsv"), experiments, files_per_mate=2))
+
+    def run():
+        first_files, second_files, rejected = get_work_plan(metadata, EXP_COLUMNS)
+        for _ in iter_pairs(first_files, second_files, EXP_COLUMNS):
+            pass
+    return run, experiments * 2, "experiments"
+
+
+CASES = {
+    "get_reads_count": bench_get_reads_count,
+    "get_reads_count_threads": bench_get_reads_count_threads,
+    "download_files": bench_download_files,
+    "generate_jobs": bench_generate_jobs,
+    "get_files": bench_get_files,
+    "get_files_cached": bench_get_files_cached,
+    "get_metadata": bench_get_metadata,
+    "pairing": bench_pairing
+}
+
+
+def measure(case, workdir, scale, repeat):
+    """
+    Returns the best throughput among repeats and the peak of traced memory
+    measured in a separate run, as tracing slows down allocation-heavy code.
+    I/O-bound cases return the median throughput of at least IO_REPEAT runs
+    """
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        run, units, unit_name = CASES[case](workdir, scale)
+        throughputs = []
+        for _ in range(max(repeat, IO_REPEAT) if case in IO_CASES else repeat):
+            start = time.perf_counter()
+            run()
+            throughputs.append(units / (time.perf_counter() - start))
+        throughput = median(throughputs) if case in IO_CASES else max(throughputs)
+        tracemalloc.start()
+        run()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"throughput": throughput, "unit": unit_name + "/s", "peak_memory": peak_memory}
+
+
+def get_host():
+    """Returns parameters of the host that throughput depends on"""
+    return {"cpu_count": os.cpu_count(), "python": platform.python_version()}
+
+
+def compare(case, result, baseline, tolerance):
+    """Returns a list of regressions comparing result with the baseline of the case"""
+    expected = baseline.get(case)
+    if not expected:
+        return []
+    regressions = []
+    if result["throughput"] < expected["throughput"] * (1 - tolerance):
+        regressions.append(f"""throughput {result["throughput"]:.0f} < {expected["throughput"]:.0f} {result["unit"]}""")
+    if result["peak_memory"] > expected["peak_memory"] * (1 + tolerance):
+        regressions.append(f"""peak memory {result["peak_memory"]} > {expected["peak_memory"]} bytes""")
+    return regressions
+
+
+def main(argsl=None):
+    if argsl is None:
+        argsl = sys.argv[1:]
+    args,_ = arg_parser().parse_known_args(argsl)
+    try:
+        with open(args.baseline, "r") as input_stream:
+            baseline = load(input_stream)
+    except (OSError, ValueError):
+        baseline = {}
+    host, baseline_host = get_host(), baseline.pop("host", None)
+    comparable = baseline_host == host
+    if not comparable and not args.update:
+        print(f"""Baseline was measured on {baseline_host or "unknown host"}, not on {host}. Regressions are reported but not failed\n""")
+    results = {}
+    failed = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for case in args.case or CASES:
+            try:
+                results[case] = measure(case, workdir, args.scale, args.repeat)
+            except (ImportError, SkipCase) as err:
+                print(f"""SKIP  {case:24}  {err}""")
+                continue
+            tolerance = args.io_tolerance if case in IO_CASES else args.tolerance
+            regressions = [] if args.update else compare(case, results[case], baseline, tolerance)
+            if regressions and comparable:
+                failed.append(case)
+            status = ("FAIL" if comparable else "WARN") if regressions else "OK"
+            print(f"""{status:4}  {case:24}  {results[case]["throughput"]:>14.0f} {results[case]["unit"]:14}"""
+                  f"""  peak {results[case]["peak_memory"] / 1024 / 1024:8.1f} MiB  {"; ".join(regressions)}""")
+    if args.update:
+        baseline = baseline if comparable else {}                      # results from another host can't be mixed
+        baseline.update(results)
+        baseline["host"] = host
+        with open(args.baseline, "w") as output_stream:
+            output_stream.write(dumps(baseline, indent=4, sort_keys=True) + "\n")
+        print("\nSave baseline to", args.baseline)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
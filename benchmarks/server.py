@@ -0,0 +1,89 @@
+"""Local HTTP servers: files with Range support the same way ENCODE does and Airflow REST API stub"""
+
+import os
+import threading
+import http.server
+from functools import partial
+from json import dumps, loads
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files with Range support. Requested paths and ranges are kept in server.requests"""
+
+    def send_head(self):
+        self.server.requests.append({"path": self.path, "range": self.headers.get("Range")})
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return None
+        size = os.path.getsize(path)
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            if start >= size:
+                self.send_error(416, "Requested Range Not Satisfiable")
+                return None
+            self.send_response(206)
+            self.send_header("Content-Range", f"""bytes {start}-{size - 1}/{size}""")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/gzip")
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        input_stream = open(path, "rb")
+        input_stream.seek(start)
+        return input_stream
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(folder, port=0):
+    """Serves folder in a background thread. Returns server and its base URL"""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), partial(RangeRequestHandler, directory=folder))
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"""http://127.0.0.1:{server.server_address[1]}"""
+
+
+class AirflowStubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Accepts POST /api/v1/dags/{dag_id}/dagRuns like Airflow REST API does. Dag run ids with
+    "conflict" get 409, ones with "flaky" get 503 on the first attempt. Requests are kept in server.requests
+    """
+
+    protocol_version = "HTTP/1.1"                                      # keeps connections alive as Airflow does
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        data = loads(body or b"{}")
+        with self.server.lock:
+            self.server.requests.append({"path": self.path, "headers": dict(self.headers), "data": data})
+            attempts = sum(1 for request in self.server.requests if request["data"].get("dag_run_id") == data.get("dag_run_id"))
+        run_id = data.get("dag_run_id", "")
+        if "conflict" in run_id:
+            self.send_json(409, {"detail": f"""DAGRun with DAG ID and run ID {run_id} already exists"""})
+        elif "flaky" in run_id and attempts == 1:
+            self.send_json(503, {"detail": "Service Unavailable"})
+        else:
+            self.send_json(200, {"dag_run_id": run_id, "state": "queued"})
+
+    def send_json(self, status, data):
+        body = dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_airflow_stub(port=0):
+    """Runs Airflow REST API stub in a background thread. Returns server and its base URL"""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), AirflowStubHandler)
+    server.requests = []
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"""http://127.0.0.1:{server.server_address[1]}"""
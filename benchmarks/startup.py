@@ -0,0 +1,78 @@
+"""
+Measures cold-start time of the console scripts and fails if any of them is slower
+than the limit or imports pandas or numpy when it doesn't need metadata frame.
+
+    python benchmarks/startup.py [--repeat 5] [--limit 0.5]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["pandas", "numpy"]                                   # should be imported only when needed
+HEAVY_CHECK = f"""import atexit, sys; atexit.register(lambda: sys.stderr.write(''.join(f'LOADED {{name}}\\n' for name in {HEAVY_MODULES!r} if name in sys.modules)))"""
+
+
+def arg_parser():
+    general_parser = argparse.ArgumentParser()
+    general_parser.add_argument("-r", "--repeat", help="Number of runs per entry point. Default: 5",            type=int,   default=5)
+    general_parser.add_argument("-l", "--limit",  help="Max median start time in seconds. Default: 0.5",        type=float, default=0.5)
+    return general_parser
+
+
+def get_cases(temp_folder):
+    fastq_folder = os.path.join(temp_folder, "fastq")
+    os.makedirs(fastq_folder, exist_ok=True)
+    for sample in ["S1", "S2"]:
+        for mate in [1, 2]:
+            open(os.path.join(fastq_folder, f"""{sample}_R{mate}.fastq.gz"""), "w").close()
+    metadata_file = os.path.join(temp_folder, "metadata.tsv")
+    with open(metadata_file, "w") as output_stream:
+        output_stream.write("file\tcategory\nS1\tcontrol\nS2\ttreated\n")
+    return [
+        ("submit-max-atac-job --help", "job_generator.submit_max_atac_job", ["--help"]),
+        ("get-salmon-deseq-job --help", "job_generator.get_salmon_deseq_job", ["--help"]),
+        ("get-salmon-deseq-job small run", "job_generator.get_salmon_deseq_job", [
+            "-m", metadata_file, "-f", fastq_folder, "-i", temp_folder, "-t", metadata_file,
+            "-o", temp_folder, "-w", metadata_file, "-u", "benchmark", "-r", os.path.join(temp_folder, "job.json")
+        ])
+    ]
+
+
+def run_case(module, params):
+    """Returns wall time of the cold start and the set of imported heavy modules"""
+    code = f"""{HEAVY_CHECK}; import runpy; sys.argv = {[module] + params!r}; runpy.run_module({module!r}, run_name="__main__")"""
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-c", code], cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if process.returncode not in (0, None):
+        raise Exception(f"""{module} {params} failed:\n{process.stderr}""")
+    return elapsed, {name for name in HEAVY_MODULES if f"""LOADED {name}""" in process.stderr.splitlines()}
+
+
+def main(argsl=None):
+    if argsl is None:
+        argsl = sys.argv[1:]
+    args,_ = arg_parser().parse_known_args(argsl)
+    failed = []
+    with tempfile.TemporaryDirectory() as temp_folder:
+        for name, module, params in get_cases(temp_folder):
+            results = [run_case(module, params) for _ in range(args.repeat)]
+            elapsed = median([result[0] for result in results])
+            loaded = sorted(set().union(*[result[1] for result in results]))
+            status = "OK"
+            if elapsed > args.limit or loaded:
+                status = "FAIL"
+                failed.append(name)
+            print(f"""{status:4}  {name:32}  median {elapsed:.3f} s  {", ".join(loaded) + " loaded" if loaded else "pandas and numpy not loaded"}""")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,93 @@
+"""Generators of synthetic FASTQ files, metadata tables and folder trees for benchmarks"""
+
+import os
+import gzip
+import random
+
+
+BASES = "ACGT"
+ENCODE_HEADER = [
+    "File accession", "File format", "Output type", "Experiment accession", "Assay", "Biosample term name",
+    "Biological replicate(s)", "Technical replicate(s)", "Read length", "Run type", "Paired end",
+    "Paired with", "Size", "md5sum", "File download URL", "Read count"
+]
+
+
+def get_reads(reads, read_length=50, mate=1, start=0, seed=0):
+    """Returns decompressed FASTQ data with reads named the same way for both mates"""
+    rnd = random.Random(seed)
+    sequence = "".join(rnd.choice(BASES) for _ in range(read_length * 16))
+    quality = "I" * read_length
+    lines = []
+    for i in range(start, start + reads):
+        offset = (i * 7) % (len(sequence) - read_length)
+        lines.append(f"""@read.{i} {i}/{mate}\n{sequence[offset:offset+read_length]}\n+\n{quality}\n""")
+    return "".join(lines).encode()
+
+
+def make_fastq(filepath, reads, read_length=50, mate=1, members=1, level=6, seed=0):
+    """Writes gzip compressed FASTQ file with reads split into members gzip members"""
+    per_member = -(-reads // members)
+    with open(filepath, "wb") as output_stream:
+        for start in range(0, reads, per_member):
+            data = get_reads(min(per_member, reads - start), read_length, mate, start, seed)
+            output_stream.write(gzip.compress(data, level))
+    return filepath
+
+
+def make_encode_metadata(filepath, experiments, files_per_mate=1, base_url="http://localhost:8000", size=1000000, reads=10000):
+    """Writes ENCODE-like metadata table with paired-ended runs and some single-ended noise"""
+    rows = []
+    accession = 0
+    for experiment in range(experiments):
+        for replicate in [1, 2]:
+            for technical in range(1, files_per_mate + 1):
+                first, second = f"""ENCFF{accession:06d}A""", f"""ENCFF{accession:06d}B"""
+                accession += 1
+                for mate, current, paired in [(1, first, second), (2, second, first)]:
+                    rows.append([
+                        current, "fastq", "reads", f"""ENCSR{experiment:06d}""", "ATAC-seq", "K562",
+                        replicate, technical, 50, "paired-ended", mate, paired, size, "", f"""{base_url}/{current}.fastq.gz""", reads
+                    ])
+        single = f"""ENCFF{accession:06d}S"""
+        accession += 1
+        rows.append([single, "fastq", "reads", f"""ENCSR{experiment:06d}""", "ATAC-seq", "K562", 1, 1, 50,
+                     "single-ended", "", "", size, "", f"""{base_url}/{single}.fastq.gz""", reads])
+    with open(filepath, "w") as output_stream:
+        output_stream.write("\t".join(ENCODE_HEADER) + "\n")
+        output_stream.writelines("\t".join(str(value) for value in row) + "\n" for row in rows)
+    return filepath
+
+
+def make_sra_metadata(filepath, experiments, runs_per_experiment=2):
+    with open(filepath, "w") as output_stream:
+        output_stream.write("exp_id\ttechnical_rep\tsrr_id\n")
+        for experiment in range(experiments):
+            for run in range(runs_per_experiment):
+                output_stream.write(f"""GSM{experiment:06d}\t{run + 1}\tSRR{experiment * runs_per_experiment + run:08d}\n""")
+    return filepath
+
+
+def make_salmon_metadata(filepath, samples):
+    with open(filepath, "w") as output_stream:
+        output_stream.write("file\tcategory\n")
+        output_stream.writelines(f"""SRR{sample:08d}\t{"control" if sample % 2 else "treated"}\n""" for sample in range(samples))
+    return filepath
+
+
+def make_tree(root, folders, files_per_folder, fanout=10):
+    """Creates folders nested with fanout subfolders per level, each with empty FASTQ and side files"""
+    paths = [root]
+    sample = 0
+    for index in range(folders):
+        parent = paths[index // fanout] if index else root
+        folder = os.path.join(parent, f"""folder_{index:05d}""") if index else root
+        os.makedirs(folder, exist_ok=True)
+        if index:
+            paths.append(folder)
+        for _ in range(files_per_folder // 2):
+            for mate in [1, 2]:
+                open(os.path.join(folder, f"""SRR{sample:08d}_{mate}.fastq.gz"""), "w").close()
+            sample += 1
+        open(os.path.join(folder, "README.txt"), "w").close()
+    return sample
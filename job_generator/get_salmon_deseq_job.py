@@ -2,15 +2,17 @@ import sys
 import argparse
 import os
 import uuid
-import pandas as pd
-import re
+from contextlib import redirect_stdout
 from json import dumps
-from job_generator.utils.utils import normalize_args, get_files, export_to_file
+from job_generator.utils.utils import normalize_args, get_files, export_to_file, get_cache_folder, read_table_dict
+from job_generator.utils.matcher import match_samples, get_unresolved_samples
+from job_generator.utils import metrics
 
 
 def arg_parser():
     general_parser = argparse.ArgumentParser()
-    general_parser.add_argument("-m", "--metadata",  help="Path to metadata file",                        required=True)
+    general_parser.add_argument("-m", "--metadata",  help="Path to metadata file(s)",                     nargs="+", default=[])
+    general_parser.add_argument("-n", "--manifest",  help="Path to file with metadata paths and optional uids, one TSV line per cohort")
     general_parser.add_argument("-f", "--fastq",     help="Path to FASTQ file folder",                    required=True)
     general_parser.add_argument("-i", "--indices",   help="Path to indices folder",                       required=True)
     general_parser.add_argument("-t", "--transform", help="Path to Tx to Gene transform file",            required=True)
@@ -19,15 +21,54 @@ def arg_parser():
 
     general_parser.add_argument("-p", "--threads", type=int, help="Number of threads to use. Default: 1",       default=1)
     general_parser.add_argument("-u", "--uid",               help="Experiment unique ID. Default: uuid4", default=str(uuid.uuid4()))
-    general_parser.add_argument("-r", "--result",            help="Output job file name. Defautl: ./uid.json")
+    general_parser.add_argument("-r", "--result",            help="Output job file name or output folder for several cohorts. Defautl: ./uid.json")
+    general_parser.add_argument("-j", "--jsonl",             help="Stream jobs as JSON Lines to file instead, '-' for stdout")
+    general_parser.add_argument("--report",                  help="Save timing report to JSON file")
+    general_parser.add_argument("-v", "--verbose",           help="Print FASTQ files, metadata and generated jobs", action="store_true")
+    general_parser.add_argument("-e", "--regex",             help="Treat sample names as regular expressions", action="store_true")
+    general_parser.add_argument("-x", "--exclude",           help="Skip folders which names match regular expression")
+    general_parser.add_argument("-c", "--cache",             help="Path to cache folder. Default: $JOB_GENERATOR_CACHE")
     return general_parser
 
 
+SMALL_METADATA_SIZE = 1024 * 1024
+
+
+@metrics.timed("get_metadata")
 def get_metadata(metadata_file):
+    if os.path.getsize(metadata_file) <= SMALL_METADATA_SIZE:                # importing pandas takes longer than reading
+        return read_table_dict(metadata_file)
+    import pandas as pd
     return pd.read_table(metadata_file, index_col=0, comment='#').to_dict(orient="index")
 
 
-def generate_jobs (args, metadata, filelist):
+def get_cohorts(args):
+    """
+    Returns [(metadata_file, uid)] from --metadata and --manifest. For several cohorts uid defaults
+    to metadata basename. Fails if uids are not unique, as their jobs would overwrite each other
+    """
+    cohorts = [(os.path.normpath(os.path.join(os.getcwd(), metadata_file)), None) for metadata_file in args.metadata]
+    if args.manifest:
+        with open(args.manifest, "r") as input_stream:
+            for line in input_stream:
+                fields = line.split("#", 1)[0].strip().split("\t")
+                if fields[0]:
+                    metadata_file = os.path.normpath(os.path.join(os.path.dirname(args.manifest), fields[0]))
+                    cohorts.append((metadata_file, fields[1] if len(fields) > 1 else None))
+    if len(cohorts) == 1:
+        return [(cohorts[0][0], cohorts[0][1] or args.uid)]
+    cohorts = [(metadata_file, uid or os.path.basename(metadata_file).split(".")[0]) for metadata_file, uid in cohorts]
+    uids = {}
+    for metadata_file, uid in cohorts:
+        uids.setdefault(uid, []).append(metadata_file)
+    duplicates = {uid: metadata_files for uid, metadata_files in uids.items() if len(metadata_files) > 1}
+    if duplicates:
+        raise Exception(f"""Cohorts have the same uid, set unique uids in --manifest:\n{dumps(duplicates, indent=4)}""")
+    return cohorts
+
+
+def generate_jobs (args, metadata, filelist, uid=None):
+    uid = uid or args.uid
     job = {
         "fastq_file_upstream": [],
         "fastq_file_downstream": [],
@@ -40,19 +81,20 @@ def generate_jobs (args, metadata, filelist):
             "class": "File",
             "location": args.transform
         },
-        "deseq_filename": args.uid + ".tsv",
+        "deseq_filename": uid + ".tsv",
         "threads": args.threads,
         "workflow": args.workflow,
         "output_folder": args.output,
-        "uid": args.uid
+        "uid": uid
     }
 
+    matches = match_samples(metadata.keys(), filelist, args.regex)
     for key, value in metadata.items():
-        print("\nProcess: ", key)
-        selected_files = sorted([path for filename, path in filelist.items() if re.match(".*" + key + ".*", filename)])
+        selected_files = matches[str(key)]
         if len(selected_files) < 2:
             continue
-        print("Selected FASTQ files:\n", dumps(selected_files, indent=4))
+        if args.verbose:
+            print("\nProcess: ", key, "\nSelected FASTQ files:\n", dumps(selected_files, indent=4))
         job["fastq_file_upstream"].append({
             "class": "File",
             "location": selected_files[0]
@@ -63,28 +105,64 @@ def generate_jobs (args, metadata, filelist):
         })
         job["category"].append(value["category"])
 
+    missing, ambiguous = get_unresolved_samples(matches)
+    if missing:
+        print(f"""\n{uid}: samples with less than two matched FASTQ files (skipped):\n""", dumps(missing))
+    if ambiguous:
+        print(f"""\n{uid}: samples with more than two matched FASTQ files (first two are used):\n""", dumps(ambiguous))
     return job
 
 
+def iter_jobs(args, cohorts, filelist):
+    """Yields (uid, job) for each (metadata_file, uid) from cohorts sharing the same list of FASTQ files"""
+    for metadata_file, uid in cohorts:
+        metadata = get_metadata(metadata_file)
+        if args.verbose:
+            print("\nLoad metadata:\n", dumps(metadata, indent=4))
+        yield uid, generate_jobs(args, metadata, filelist, uid)
+
+
+def export_jobs(args, cohorts, output_stream=None):
+    fastq_files, collisions = get_files(args.fastq, ".*fastq.*", args.exclude, get_cache_folder(args.cache))
+    print(f"""\nFound {len(fastq_files)} FASTQ files""")
+    if args.verbose:
+        print("\nGet list of FASTQ files:\n",dumps(fastq_files, indent=4))
+    if collisions:
+        print("\nFound FASTQ files with identical basenames (first one is used):\n", dumps(collisions, indent=4))
+
+    for uid, job in iter_jobs(args, cohorts, fastq_files):
+        if args.verbose:
+            print("\nGenerate job:\n", dumps(job, indent=4))
+        if output_stream:
+            output_stream.write(dumps(job) + "\n")
+        else:
+            result = os.path.join(args.result, uid + ".json") if len(cohorts) > 1 else args.result
+            export_to_file(dumps(job, indent=4), result)
+            print("\nExport job to file:\n", result)
+
+
 def main(argsl=None):
     if argsl is None:
         argsl = sys.argv[1:]
     args,_ = arg_parser().parse_known_args(argsl)
-    args = normalize_args(args, ['uid','threads'])
+    args = normalize_args(args, ['metadata','uid','threads','regex','exclude','verbose','jsonl'])
+    cohorts = get_cohorts(args)
+    if not cohorts:
+        arg_parser().error("at least one of -m/--metadata or -n/--manifest is required")
     if not args.result:
-        args.result = os.path.join(os.getcwd(), args.uid + ".json")
-
-    fastq_files = get_files(args.fastq, ".*fastq.*")
-    print("\nGet list of FASTQ files:\n",dumps(fastq_files, indent=4))
-
-    metadata = get_metadata(args.metadata)
-    print("\nLoad metadata:\n", dumps(metadata, indent=4))
-
-    job = generate_jobs(args, metadata, fastq_files)
-    print("\nGenerate job:\n", dumps(job, indent=4))
-
-    export_to_file(dumps(job, indent=4), args.result)
-    print("\nExport job to file:\n", args.result)
+        args.result = os.getcwd() if len(cohorts) > 1 else os.path.join(os.getcwd(), args.uid + ".json")
+
+    if args.jsonl == "-":
+        with redirect_stdout(sys.stderr):                                       # keep stdout for jobs only
+            export_jobs(args, cohorts, sys.__stdout__)
+    elif args.jsonl:
+        with open(args.jsonl, "w") as output_stream:
+            export_jobs(args, cohorts, output_stream)
+        print("\nExport jobs to file:\n", os.path.abspath(args.jsonl))
+    else:
+        export_jobs(args, cohorts)
+    if args.report:
+        metrics.export_report(args.report)
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv[1:]))
\ No newline at end of file
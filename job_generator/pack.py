@@ -1,17 +1,79 @@
 import sys
 import os
+import re
+import argparse
 
-with open(sys.argv[1], 'r') as s:
-    for l in s:
-        if "run:" in l:
-            indentation = l.split("run:")[0]
-            p = os.path.join(os.getcwd(),l.split(":")[1].strip())
-            print(indentation+"run:")
-            with open(p, 'r') as ss:
-                for ll in ss:
-                    if "s:mainEntity" in ll or "$import" in ll:
-                        continue
-                    else:
-                        print(indentation+indentation+ll.rstrip())
+
+RUN_PATTERN = re.compile(r"""^(\s*)run:\s*["']?([^"'#\s][^"'\s]*)["']?\s*(#.*)?$""")   # run: path/to/step.cwl  # comment
+SKIP_PATTERNS = ["s:mainEntity", "$import"]                                    # not allowed in inlined steps
+
+
+def arg_parser():
+    general_parser = argparse.ArgumentParser()
+    general_parser.add_argument("workflow",       help="Path to CWL workflow file")
+    general_parser.add_argument("-o", "--output", help="Path to save packed workflow. Default: stdout")
+    return general_parser
+
+
+def parse_file(filepath, parsed):
+    """
+    Returns lines of filepath as [(line, referenced filepath or None)]. Referenced files are
+    resolved relatively to the folder of filepath. Each file is read only once and kept in parsed
+    """
+    if filepath not in parsed:
+        folder = os.path.dirname(filepath)
+        lines = []
+        with open(filepath, "r") as input_stream:
+            for line in input_stream:
+                match = RUN_PATTERN.match(line)
+                reference = os.path.realpath(os.path.join(folder, match.group(2))) if match else None
+                lines.append((line.rstrip(), reference))
+        parsed[filepath] = lines
+    return parsed[filepath]
+
+
+def pack(filepath, output_stream, prefix="", parsed=None, stack=None):
+    """
+    Writes filepath to output_stream replacing each run: reference with the content of the referenced
+    file, recursively. Inlined lines are indented by the doubled indentation of their run: line.
+    Fails on circular references
+    """
+    parsed = {} if parsed is None else parsed
+    stack = [] if stack is None else stack
+    if filepath in stack:
+        raise Exception(f"""Circular reference: {" -> ".join(stack[stack.index(filepath):] + [filepath])}""")
+    stack.append(filepath)
+    for line, reference in parse_file(filepath, parsed):
+        if prefix and any(pattern in line for pattern in SKIP_PATTERNS):
+            continue
+        if reference:
+            if not os.path.isfile(reference):
+                raise Exception(f"""File {reference} referenced from {filepath} is missing""")
+            indentation = line.split("run:")[0]
+            output_stream.write(prefix + indentation + "run:\n")
+            pack(reference, output_stream, prefix + indentation + indentation, parsed, stack)
         else:
-            print(l.rstrip())
\ No newline at end of file
+            output_stream.write(prefix + line + "\n")
+    stack.pop()
+
+
+def main(argsl=None):
+    if argsl is None:
+        argsl = sys.argv[1:]
+    args,_ = arg_parser().parse_known_args(argsl)
+    workflow = os.path.realpath(args.workflow)
+    if args.output:
+        temp_output = f"""{args.output}.{os.getpid()}.tmp"""
+        try:
+            with open(temp_output, "w") as output_stream:
+                pack(workflow, output_stream)
+            os.replace(temp_output, args.output)
+        finally:
+            if os.path.isfile(temp_output):
+                os.remove(temp_output)
+    else:
+        pack(workflow, sys.stdout)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
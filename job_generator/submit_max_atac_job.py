@@ -1,119 +1,344 @@
 import sys
 import os
 import argparse
-import gzip
-import pandas as pd
+import hashlib
+import glob
+import time
+import shutil
+import tempfile
 import subprocess
+from itertools import islice
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from json import dumps
-from job_generator.utils.utils import normalize_args
+from job_generator.utils.utils import normalize_args, get_cache_folder, get_folder, get_checksum
+from job_generator.utils.download import fetch_file, get_cached_filepath
+from job_generator.utils.airflow import trigger_dags, TRIGGER_BACKENDS
+from job_generator.utils.pipeline import run_pipeline
+from job_generator.utils.compress import ParallelGzipWriter
+from job_generator.utils.pairing import get_work_plan, iter_pairs
+from job_generator.utils.scheduler import DiskBudget, estimate_footprint, parse_size, set_bandwidth, SIZE_COLUMN, READS_COLUMN
+from job_generator.utils import metrics
+from job_generator.utils.state import open_state, get_state, get_finished, set_state, set_error, get_status, is_reached, STATES, FIELDS
+from job_generator.utils.fastq import (
+    open_location, iter_decompressed, copy_reads, copy_paired_reads, get_reads_count, set_cached_reads_count
+)
 
 
 INDEX_COLUMNS = ["Experiment accession", "Biological replicate(s)", "Paired end", "Technical replicate(s)"]
 EXP_COLUMNS = ["Experiment accession", "Biological replicate(s)"]
 FILTER_COLUMN = "Run type"
 FILTER_VALUE = "paired-ended"
+METADATA_COLUMNS = INDEX_COLUMNS + [FILTER_COLUMN, "File accession", "Paired with", "File download URL", "md5sum", SIZE_COLUMN, READS_COLUMN]
+METADATA_DTYPES = {FILTER_COLUMN: "category", "Paired end": "float32"}
 INDEX_COLUMNS_SRA = ["exp_id", "technical_rep"]
 EXP_COLUMNS_SRA = ["exp_id"]
+METADATA_COLUMNS_SRA = INDEX_COLUMNS_SRA + ["srr_id"]
+STAGE_STATES = {"prepare": "paired", "pair": "paired", "extract": "downloaded", "download": "downloaded", "count": "counted", "trigger": "triggered"}
+REJECTED_TO_PRINT = 20
+REQUIRED_ARGS = ["metadata", "dag", "indices", "blacklisted", "genome", "output"]          # not needed for --status
 CWD = os.getcwd()
+CHUNK_SIZE = 1024 * 1024
+SRATOOLKIT_IMAGE = "biowardrobe2/sratoolkit:v2.8.2-1"
 
 
 def arg_parser():
     general_parser = argparse.ArgumentParser()
-    general_parser.add_argument("-m", "--metadata",    help="Path to metadata file",                         required=True)
-    general_parser.add_argument("-d", "--dag",         help="Dag id",                                        required=True)
-    general_parser.add_argument("-i", "--indices",     help="Path to indices folder",                        required=True)
-    general_parser.add_argument("-b", "--blacklisted", help="Path to blacklisted regions file",              required=True)
-    general_parser.add_argument("-g", "--genome",      help="Path to genome FASTA file",                     required=True)
+    general_parser.add_argument("-m", "--metadata",    help="Path to metadata file. Required unless --status")
+    general_parser.add_argument("-d", "--dag",         help="Dag id. Required unless --status")
+    general_parser.add_argument("-i", "--indices",     help="Path to indices folder. Required unless --status")
+    general_parser.add_argument("-b", "--blacklisted", help="Path to blacklisted regions file. Required unless --status")
+    general_parser.add_argument("-g", "--genome",      help="Path to genome FASTA file. Required unless --status")
     general_parser.add_argument("-n", "--number",      help="Limit number of experiments to submit",         type=int)
     general_parser.add_argument("-c", "--counts",      help="Limit read counts per submitted experiment",    type=int, default=100000000)
     general_parser.add_argument("-t", "--threads",     help="Threads number",                                type=int, default=4)
-    general_parser.add_argument("-o", "--output",      help="Path to be used as output_folder in job files", required=True)
-    general_parser.add_argument("-f", "--fdump",       help="Path to fastq-dump (use it with --sra). Run from Docker if not set")
+    general_parser.add_argument("-o", "--output",      help="Path to be used as output_folder in job files. Required unless --status")
+    general_parser.add_argument("-f", "--fdump",       help="Path to fastq-dump or fasterq-dump (use it with --sra). Run from Docker if not set")
     general_parser.add_argument("-s", "--sra",         help="Use metadata file with SRA identifiers",        action="store_true")
     general_parser.add_argument("-l", "--local",       help="Work with pre-downloaded fastq files. Only for --sra", action="store_true")
     general_parser.add_argument("-r", "--rerun",       help="Rerun expreriment",                             action="store_true")
     general_parser.add_argument("-w", "--download",    help="Skip triggering. Only download data",           action="store_true")
     general_parser.add_argument("-p", "--suffix",      help="Run id suffix",                                 type=str, default="")
+    general_parser.add_argument("-j", "--jobs",        help="Number of experiments to download in parallel", type=int, default=1)
+    general_parser.add_argument("--count-jobs",        help="Number of experiments to count reads in parallel", type=int, default=1)
+    general_parser.add_argument("--sra-jobs",          help="Number of SRR runs to extract in parallel per experiment, sharing --threads", type=int, default=1)
+    general_parser.add_argument("--trigger-jobs",      help="Number of experiments to trigger in parallel",  type=int, default=1)
+    general_parser.add_argument("--trigger-batch",     help="Max number of ready experiments to trigger at once. Default: 20", type=int, default=20)
+    general_parser.add_argument("-a", "--paired",      help="Stream R1 and R2 side by side checking read names", action="store_true")
+    general_parser.add_argument("-e", "--spread",      help="Take reads evenly from all files. Only for --paired", action="store_true")
+    general_parser.add_argument("--compress-level",    help="Gzip compression level of combined FASTQ files. Default: 6", type=int, default=6)
+    general_parser.add_argument("--compress-threads",  help="Threads number to compress combined FASTQ files. Default: --threads", type=int)
+    general_parser.add_argument("--disk-budget",       help="Limit disk space used by combined and cached files, e.g. 500G. Free space is always checked")
+    general_parser.add_argument("--bandwidth",         help="Limit total download rate in bytes per second, e.g. 100M")
+    general_parser.add_argument("--delete-cached",     help="Delete files fetched to --cache right after streaming them", action="store_true")
+    general_parser.add_argument("-k", "--cache",       help="Path to download cache folder. Default: $JOB_GENERATOR_CACHE")
+    general_parser.add_argument("-y", "--trigger-backend", help="Trigger dags with airflow CLI, REST API or save them to files. Default: cli", choices=TRIGGER_BACKENDS, default="cli")
+    general_parser.add_argument("-u", "--airflow-url",     help="Airflow webserver URL for rest backend. Default: $AIRFLOW_URL or http://localhost:8080")
+    general_parser.add_argument("-x", "--trigger-folder",  help="Folder to save dag runs for file backend. Default: current directory")
+    general_parser.add_argument("--report",            help="Save per experiment timing and throughput report to JSON file")
+    general_parser.add_argument("--prom",              help="Save stage metrics to Prometheus textfile")
+    general_parser.add_argument("--validate",          help="Only validate pairing of all experiments and exit", action="store_true")
+    general_parser.add_argument("--plan",              help="Save work plan with paired files of accepted experiments to TSV file")
+    general_parser.add_argument("--rejected",          help="Save rejected experiments with reasons to TSV file")
+    general_parser.add_argument("--state",             help="Path to SQLite database to save experiments state. Finished stages are skipped on restart")
+    general_parser.add_argument("--status",            help="Print experiments state from --state database and exit", action="store_true")
+    general_parser.add_argument("--profile",           help="Profile experiment with run id (without suffix) and save it to ./run_id.prof")
     return general_parser
 
 
-def get_metadata(metadata_file):
-    raw_data = pd.read_table(metadata_file, index_col=INDEX_COLUMNS, comment='#')
-    return raw_data.loc[raw_data[FILTER_COLUMN] == FILTER_VALUE].sort_index()
+def read_metadata(metadata_file, index_columns, columns, dtypes=None, filter_by=None, cache_folder=None):
+    """
+    Reads only columns from metadata_file, keeps rows with filter_by (column, value)
+    and sorts them by index_columns. If cache_folder is set, parsed data is pickled
+    there with the key that depends on the file content and reading parameters
+    """
+    import pandas as pd                                                   # heavy import, not needed for --help
+    cache_filepath = None
+    if cache_folder:
+        params = dumps([index_columns, columns, dtypes, filter_by, pd.__version__])
+        cache_key = get_checksum(metadata_file, "sha1") + hashlib.sha1(params.encode()).hexdigest()[:8]
+        cache_filepath = os.path.join(get_folder(os.path.join(cache_folder, "metadata")), cache_key + ".pkl")
+        if os.path.isfile(cache_filepath):
+            print("Load cached metadata", cache_filepath)
+            return pd.read_pickle(cache_filepath)
+    raw_data = pd.read_table(metadata_file, comment='#', usecols=lambda column: column in columns, dtype=dtypes)
+    if filter_by:
+        raw_data = raw_data.loc[raw_data[filter_by[0]] == filter_by[1]]
+    metadata = raw_data.set_index(index_columns).sort_index()
+    if cache_filepath:
+        temp_filepath = f"""{cache_filepath}.{os.getpid()}.tmp"""
+        metadata.to_pickle(temp_filepath)
+        os.replace(temp_filepath, cache_filepath)
+    return metadata
 
 
-def get_reads_count(filename):
-    counter = 0
-    with gzip.open(filename, "rb") as input_stream:
-        for counter, _ in enumerate(input_stream):
-            pass
-    return int((counter + 1) / 4)
+@metrics.timed("get_metadata")
+def get_metadata(metadata_file, cache_folder=None):
+    return read_metadata(metadata_file, INDEX_COLUMNS, METADATA_COLUMNS, METADATA_DTYPES, (FILTER_COLUMN, FILTER_VALUE), cache_folder)
 
 
-def download_files(files_df, prefix, rerun, max_counts):
-    combined_filepath = os.path.join(CWD, prefix + ".fastq.gz")
+def check_combined_files(combined_filepaths, rerun):
+    """Returns True if combined files should be reused for rerun. Fails if they are missing for rerun or exist otherwise"""
     if rerun:
-        if os.path.isfile(combined_filepath):
-            return combined_filepath
+        if all(os.path.isfile(filepath) for filepath in combined_filepaths):
+            return True
         else:
-            raise Exception(f"""File {combined_filepath} is missing. Cannot rerun""")
+            raise Exception(f"""File {" or ".join(combined_filepaths)} is missing. Cannot rerun""")
     else:
-        if os.path.isfile(combined_filepath):
-            raise Exception(f"""File {combined_filepath} already exists""")
-    current_counts = 0
-    remaining_counts = max_counts
-    for file_url in files_df["File download URL"]:
-        if remaining_counts == 0:
-            print(f"\n  Skip download. Reached max reads counts ({current_counts})")
-            break
-        current_filename = file_url.split("/")[-1]
-        current_filepath = os.path.join(CWD, current_filename)
+        if any(os.path.isfile(filepath) for filepath in combined_filepaths):
+            raise Exception(f"""File {" or ".join(combined_filepaths)} already exists""")
+    return False
+
+
+def iter_files(files_df):
+    """Yields URL, accession and md5sum (None if unknown) of each file"""
+    md5sums = files_df["md5sum"] if "md5sum" in files_df else [None] * len(files_df.index)
+    for file_url, accession, md5sum in zip(files_df["File download URL"], files_df["File accession"], md5sums):
+        yield file_url, accession, md5sum if isinstance(md5sum, str) and md5sum else None     # empty cells are read as NaN
+
+
+def get_fetched(files_df, cache_folder=None):
+    """Returns cached filepath for each file that will be fetched to cache_folder, None for the files already in CWD or cache"""
+    fetched = []
+    for file_url, accession, md5sum in iter_files(files_df):
+        cached_filepath = get_cached_filepath(cache_folder, file_url, accession, md5sum) if cache_folder else None
+        if cached_filepath and (os.path.isfile(os.path.join(CWD, file_url.split("/")[-1])) or os.path.isfile(cached_filepath)):
+            cached_filepath = None
+        fetched.append(cached_filepath)
+    return fetched
+
+
+def iter_locations(files_df, cache_folder=None, delete_cached=False):
+    """
+    Yields location to read each file from: pre-downloaded file from CWD, cached file or URL.
+    If delete_cached is True, cached file is removed as soon as the next location is requested
+    """
+    for file_url, accession, md5sum in iter_files(files_df):
+        current_filepath = os.path.join(CWD, file_url.split("/")[-1])
         if os.path.isfile(current_filepath):
-            params = " ".join(["cat", current_filepath, "| zcat | head -n", str(4*remaining_counts), "| gzip  >>", combined_filepath])
+            yield current_filepath
+        elif cache_folder:
+            cached_filepath = fetch_file(file_url, get_cached_filepath(cache_folder, file_url, accession, md5sum), md5sum)
+            try:
+                yield cached_filepath
+            finally:                                                           # also when the reader stops early
+                if delete_cached:
+                    remove_files([cached_filepath])
         else:
-            params = " ".join(["wget", "-O", "-", "-q", "--show-progress", file_url, "| zcat | head -n", str(4*remaining_counts), "| gzip  >>", combined_filepath])
-        env = os.environ.copy()
-        print("\n  Run", params)
-        try:
-            subprocess.run(params, env=env, shell=True, check=True)
-        except Exception as err:
-            os.remove(combined_filepath)
-            raise err
-        current_counts = get_reads_count(combined_filepath)
-        remaining_counts = max_counts - current_counts
+            yield file_url
+
+
+def remove_files(filepaths):
+    for filepath in filepaths:
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+
+
+@metrics.timed("download_files")
+def download_files(files_df, prefix, rerun, max_counts, cache_folder=None, compress_level=6, compress_threads=1, delete_cached=False):
+    combined_filepath = os.path.join(CWD, prefix + ".fastq.gz")
+    if check_combined_files([combined_filepath], rerun):
+        return combined_filepath
+    current_counts = 0
+    try:
+        with ParallelGzipWriter(combined_filepath, level=compress_level, threads=compress_threads) as output_stream:
+            for location in iter_locations(files_df, cache_folder, delete_cached):     # fetches to cache only when needed
+                print("\n  Stream", location, "to", combined_filepath)
+                with open_location(location) as input_stream:
+                    current_counts += copy_reads(iter_decompressed(input_stream), output_stream, max_counts - current_counts)
+                print(f"  Reads count: {current_counts}")
+                if current_counts >= max_counts:
+                    print(f"\n  Skip the rest of files. Reached max reads counts ({current_counts})")
+                    break
+    except Exception as err:
+        remove_files([combined_filepath])
+        raise err
+    set_cached_reads_count(combined_filepath, current_counts)
+    metrics.add(reads=current_counts)
     return combined_filepath
 
 
-def trigger_dag(job, run_id, dag_id, suffix):
-    params = ["airflow", "trigger_dag", "-r", run_id+suffix, "-c", dumps(job), dag_id]
-    env = os.environ.copy()
-    print("Trigger dag", params)
-    subprocess.run(params, env=env)
+@metrics.timed("download_files")
+def download_paired_files(first_files, second_files, prefix, rerun, max_counts, cache_folder=None, spread=False,
+                          compress_level=6, compress_threads=1, delete_cached=False):
+    """
+    Streams R1 and R2 files side by side checking that read names match and stops both
+    at exactly max_counts pairs. If spread is True, pairs are taken evenly from all files
+    instead of the first ones
+    """
+    first_combined_filepath = os.path.join(CWD, prefix + "_R1.fastq.gz")
+    second_combined_filepath = os.path.join(CWD, prefix + "_R2.fastq.gz")
+    if check_combined_files([first_combined_filepath, second_combined_filepath], rerun):
+        return first_combined_filepath, second_combined_filepath
+    current_counts = 0
+    files_left = len(first_files.index)
+    try:
+        with ParallelGzipWriter(first_combined_filepath, level=compress_level, threads=compress_threads) as first_stream, \
+             ParallelGzipWriter(second_combined_filepath, level=compress_level, threads=compress_threads) as second_stream:
+            for first_location, second_location in zip(iter_locations(first_files, cache_folder, delete_cached),
+                                                       iter_locations(second_files, cache_folder, delete_cached)):
+                remaining_counts = max_counts - current_counts
+                quota = -(-remaining_counts // files_left) if spread else remaining_counts
+                files_left -= 1
+                print("\n  Stream", first_location, "and", second_location, "taking up to", quota, "pairs")
+                with open_location(first_location) as first_input, open_location(second_location) as second_input:
+                    current_counts += copy_paired_reads(
+                        iter_decompressed(first_input), iter_decompressed(second_input), first_stream, second_stream, quota
+                    )
+                print(f"  Pairs count: {current_counts}")
+                if current_counts >= max_counts:
+                    print(f"\n  Skip the rest of files. Reached max reads counts ({current_counts})")
+                    break
+    except Exception as err:
+        remove_files([first_combined_filepath, second_combined_filepath])
+        raise err
+    set_cached_reads_count(first_combined_filepath, current_counts)
+    set_cached_reads_count(second_combined_filepath, current_counts)
+    metrics.add(reads=2*current_counts)
+    return first_combined_filepath, second_combined_filepath
+
+
+def trigger_jobs(jobs, dag_id, suffix, backend="cli", url=None, folder=None):
+    """Triggers dag_id for all (run_id, job) from jobs in one batch. Returns {run_id: error} for failed runs"""
+    failed = trigger_dags([(run_id+suffix, job) for run_id, job in jobs], dag_id, backend, url, folder)
+    return {
+        run_id: Exception(f"""Failed to trigger {dag_id} with run id {run_id+suffix}: {failed[run_id+suffix]}""")
+        for run_id, _ in jobs if run_id+suffix in failed
+    }
+
+
+@metrics.timed("validate")
+def validate_pairing(args, metadata):
+    """
+    Pairs and validates files of all experiments before processing. Prints rejected experiments,
+    optionally saves them and the work plan to TSV files. Returns first and second mates of the
+    accepted experiments aligned row by row
+    """
+    first_files, second_files, rejected = get_work_plan(metadata, EXP_COLUMNS)
+    accepted = first_files.index.droplevel(INDEX_COLUMNS[len(EXP_COLUMNS):]).nunique()
+    print(f"""Validated {accepted + len(rejected.index)} experiment(s): {accepted} accepted, {len(rejected.index)} rejected""")
+    for _, row in islice(rejected.iterrows(), REJECTED_TO_PRINT):
+        print("  Rejected -", get_run_id(tuple(row[EXP_COLUMNS])), row["Reason"])
+    if len(rejected.index) > REJECTED_TO_PRINT:
+        print(f"""  ... and {len(rejected.index) - REJECTED_TO_PRINT} more""")
+    if args.rejected:
+        rejected.to_csv(args.rejected, sep="\t", index=False)
+        print("Export rejected experiments to", args.rejected)
+    if args.plan:
+        plan = first_files.reset_index()[EXP_COLUMNS + ["Technical replicate(s)", "File accession", "File download URL"]]
+        plan.insert(0, "run_id", [get_run_id(exp_idx) for exp_idx in zip(*[plan[column] for column in EXP_COLUMNS])])
+        plan["Second file accession"] = second_files["File accession"].to_numpy()
+        plan["Second file download URL"] = second_files["File download URL"].to_numpy()
+        plan.to_csv(args.plan, sep="\t", index=False)
+        print("Export work plan to", args.plan)
+    return first_files, second_files
+
+
+@metrics.timed("get_metadata")
+def get_metadata_sra(metadata_file, cache_folder=None):
+    return read_metadata(metadata_file, INDEX_COLUMNS_SRA, METADATA_COLUMNS_SRA, cache_folder=cache_folder)
+
+
+def start_container(folder):
+    """Starts sratoolkit container with folder mounted to /tmp/. Returns container id"""
+    params = ["docker", "run", "--rm", "--detach", "-v", f"""{folder}:/tmp/""", SRATOOLKIT_IMAGE, "sleep", "infinity"]
+    print("\n  Run", " ".join(params))
+    return subprocess.run(params, env=os.environ.copy(), check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
 
 
-def equal(f,s):
-    return (f["Paired with"].equals(s["File accession"])) and (s["Paired with"].equals(f["File accession"])) and (f.index.equals(s.index))
+def stop_container(container):
+    subprocess.run(["docker", "rm", "--force", container], env=os.environ.copy(), stdout=subprocess.DEVNULL)
 
 
-def get_properly_paired_second_files(first_files, second_files):
-    if equal(first_files, second_files):
-        return second_files
+def extract_srr(srr_id, fdump, local, threads, container=None, folder=CWD):
+    """
+    Extracts srr_id into its own temporary folder inside folder, so parallel runs never collide.
+    Without fdump runs fastq-dump in the container with folder mounted to /tmp/. Returns the
+    temporary folder (None for local files) and the paths to both mates
+    """
+    if local:
+        return None, os.path.join(CWD, f"""{srr_id}_1.fastq.gz"""), os.path.join(CWD, f"""{srr_id}_2.fastq.gz""")
+    temp_folder = tempfile.mkdtemp(prefix=f"""{srr_id}_""", dir=folder)
+    if not fdump:
+        params = ["docker", "exec", container, "fastq-dump", "--split-3", "--gzip", "--outdir",
+                  "/tmp/" + os.path.basename(temp_folder), srr_id]
+    elif os.path.basename(fdump).startswith("fasterq-dump"):                      # multi-threaded, can't compress output
+        params = [fdump, "--split-3", "--threads", str(threads), "--outdir", temp_folder, srr_id]
     else:
-        print("  Fixed pairing order")
-        row_count = len(second_files.index)
-        return second_files.iloc[pd.Index(second_files["File accession"]).get_indexer(first_files["Paired with"])]
+        params = [fdump, "--split-3", "--gzip", "--outdir", temp_folder, srr_id]
+    print("\n  Run", " ".join(params))
+    try:
+        subprocess.run(params, env=os.environ.copy(), check=True)
+        first_filepath, second_filepath = [
+            next(iter(glob.glob(os.path.join(temp_folder, f"""{srr_id}_{mate}.fastq*"""))), None) for mate in [1, 2]
+        ]
+        if not first_filepath or not second_filepath:
+            raise Exception(f"""Failed to find extracted mates of {srr_id} in {temp_folder}""")
+    except Exception:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        raise
+    return temp_folder, first_filepath, second_filepath
 
 
-def get_metadata_sra(metadata_file):
-    raw_data = pd.read_table(metadata_file, index_col=INDEX_COLUMNS_SRA, comment='#')
-    return raw_data.sort_index()
+def append_file(source_filepath, output_stream):
+    """Appends gzip compressed file as is, compresses uncompressed one"""
+    with open(source_filepath, "rb") as input_stream:
+        if source_filepath.endswith(".gz"):
+            for chunk in iter(lambda: input_stream.read(CHUNK_SIZE), b""):
+                output_stream.write_compressed(chunk)
+        else:
+            for chunk in iter(lambda: input_stream.read(CHUNK_SIZE), b""):
+                output_stream.write(chunk)
 
 
-def extract_sra(srr_files, run_id, fdump, local, rerun):
-    first_filename = run_id + "_R1.fastq.gz"
-    second_filename = run_id + "_R2.fastq.gz"
-    first_combined_filepath = os.path.join(CWD, first_filename)
-    second_combined_filepath = os.path.join(CWD, second_filename)
+@metrics.timed("extract_sra")
+def extract_sra(srr_files, run_id, fdump, local, rerun, jobs=1, threads=1, compress_level=6, compress_threads=1):
+    """
+    Extracts SRR runs, up to jobs of them in parallel sharing threads, and appends them to combined
+    files in the order of srr_files. Without fdump all runs are extracted in one container
+    """
+    first_combined_filepath = os.path.join(CWD, run_id + "_R1.fastq.gz")
+    second_combined_filepath = os.path.join(CWD, run_id + "_R2.fastq.gz")
 
     if rerun:
         if os.path.isfile(first_combined_filepath) and os.path.isfile(second_combined_filepath):
@@ -124,145 +349,352 @@ def extract_sra(srr_files, run_id, fdump, local, rerun):
         if os.path.isfile(first_combined_filepath) or os.path.isfile(second_combined_filepath):
             raise Exception(f"""File {first_combined_filepath} or {second_combined_filepath} already exists""")
 
-    for srr_id in srr_files:
-        if fdump:
-            download = f"""{fdump} --split-3 --gzip {srr_id} &&"""
-            combine = f"""cat {srr_id}_1.fastq.gz >> {first_filename} &&
-                        cat {srr_id}_2.fastq.gz >> {second_filename} &&
-                        rm {srr_id}_1.fastq.gz {srr_id}_2.fastq.gz"""
-        else:
-            download = f"""docker run --rm -ti -v {CWD}:/tmp/ biowardrobe2/sratoolkit:v2.8.2-1 fastq-dump --split-3 --gzip {srr_id} &&"""
-            combine = f"""cat {srr_id}_1.fastq.gz >> {first_filename} &&
-                        cat {srr_id}_2.fastq.gz >> {second_filename} &&
-                        rm {srr_id}_1.fastq.gz {srr_id}_2.fastq.gz"""
-
-        env = os.environ.copy()
-        if not local:
-            params = download + "\n" + combine
-        else:
-            params = combine
-        print("\n  Run", params)
-        try:
-            subprocess.run(params, env=env, shell=True, check=True)
-        except Exception as err:
+    container_folder = tempfile.mkdtemp(prefix=f"""{run_id}_""", dir=CWD) if not fdump and not local else None
+    container = None
+    extracted = []
+    errors = []
+    try:
+        container = start_container(container_folder) if container_folder else None
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(extract_srr, srr_id, fdump, local, max(1, threads // jobs), container, container_folder or CWD)
+                for srr_id in srr_files
+            ]
+        for future in futures:
             try:
-                os.remove(first_combined_filepath)
-                os.remove(second_combined_filepath)
-                os.remove(os.path.join(CWD, f"""{srr_id}_1.fastq.gz"""))
-                os.remove(os.path.join(CWD, f"""{srr_id}_2.fastq.gz"""))
-            except Exception:
-                pass
-            raise err
+                extracted.append(future.result())
+            except Exception as err:
+                errors.append(err)
+        if errors:
+            raise errors[0]
+        with ParallelGzipWriter(first_combined_filepath, level=compress_level, threads=compress_threads) as first_stream, \
+             ParallelGzipWriter(second_combined_filepath, level=compress_level, threads=compress_threads) as second_stream:
+            for temp_folder, first_filepath, second_filepath in extracted:              # keeps the order of srr_files
+                print("\n  Append", first_filepath, "and", second_filepath)
+                append_file(first_filepath, first_stream)
+                append_file(second_filepath, second_stream)
+    except Exception as err:
+        for filepath in [first_combined_filepath, second_combined_filepath]:
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+        raise err
+    finally:
+        if container:
+            stop_container(container)
+        for temp_folder, first_filepath, second_filepath in extracted:
+            if temp_folder:
+                shutil.rmtree(temp_folder, ignore_errors=True)
+        if container_folder:
+            shutil.rmtree(container_folder, ignore_errors=True)
+    if local:
+        for temp_folder, first_filepath, second_filepath in extracted:
+            os.remove(first_filepath)
+            os.remove(second_filepath)
+    metrics.add(bytes=os.path.getsize(first_combined_filepath) + os.path.getsize(second_combined_filepath))
     return first_combined_filepath, second_combined_filepath
 
 
-def submit_jobs_sra (args, metadata):
-    count = 0
-    for exp_idx, exp_data in metadata.groupby(level=EXP_COLUMNS_SRA):
-        if args.number and count >= args.number:
-            break
-        print("\n\n\nProcess experiment:\n\n  Experiment accession -", exp_idx)
-        srr_files = exp_data["srr_id"].tolist()
-        count = count + 1
+def get_job_template(args, run_id, first_combined, second_combined):
+    return {
+        "job": {
+            "fastq_file_1": {
+                "class": "File",
+                "location": first_combined
+            },
+            "fastq_file_2": {
+                "class": "File",
+                "location": second_combined
+            },
+            "indices_folder": {
+                "class": "Directory",
+                "location": args.indices
+            },
+            "blacklisted_regions_bed": {
+                "class": "File",
+                "location": args.blacklisted
+            },
+            "genome_fasta_file": {
+                "class": "File",
+                "location": args.genome
+            },
+            "genome_size": "2.7e9",
+            "outputs_folder": os.path.join(args.output, run_id),
+            "threads": args.threads
+        }
+    }
+
+
+def prepare_sra_experiment(args, experiment):
+    exp_idx = experiment["exp_idx"]
+    print("\n\n\nProcess experiment:\n\n  Experiment accession -", exp_idx)
+    srr_files = experiment["exp_data"]["srr_id"].tolist()
+    print("\n  SRR: ", srr_files)
+    return {"exp_idx": exp_idx, "run_id": get_run_id(exp_idx), "srr_files": srr_files}
+
+
+def extract_sra_experiment(args, experiment):
+    experiment["first_combined"], experiment["second_combined"] = extract_sra(
+        experiment["srr_files"], experiment["run_id"], args.fdump, args.local, args.rerun, args.sra_jobs, args.threads,
+        compress_level=args.compress_level, compress_threads=args.compress_threads
+    )
+    return experiment
+
+
+def pair_experiment(args, experiment):
+    exp_idx = experiment["exp_idx"]
+    print("\n\n\nProcess experiment:\n\n  Experiment accession -", exp_idx[0],"\n  Biological replicate -", exp_idx[1])
+    print("\n  First:\n", experiment["first_files"][["File accession", "Paired with"]])
+    print("\n  Second:\n", experiment["second_files"][["File accession", "Paired with"]])
+    experiment["run_id"] = get_run_id(exp_idx)
+    return experiment
+
+
+def get_combined_filepaths(run_id):
+    return [os.path.join(CWD, f"""{run_id}_R{mate}.fastq.gz""") for mate in [1, 2]]
+
+
+def download_experiment(args, experiment):
+    """
+    Downloads experiment when its estimated footprint fits the disk budget. Only the files written
+    by the download are counted: combined files and the files fetched to the cache, if they are kept
+    """
+    fetched = {files: get_fetched(experiment[files], args.cache) for files in ["first_files", "second_files"]}
+    estimates = [
+        estimate_footprint(experiment[files], args.counts, [bool(i) for i in fetched[files]], args.delete_cached, args.paired and args.spread)
+        for files in ["first_files", "second_files"]
+    ]
+    footprint = sum(combined + cached for combined, cached in estimates)
+    written = [filepath for filepath in get_combined_filepaths(experiment["run_id"]) if not os.path.isfile(filepath)]
+    written += [filepath for filepaths in fetched.values() for filepath in filepaths if filepath]
+    args.disk_budget.acquire(footprint, experiment["run_id"])
+    kept = 0
+    try:
+        experiment = download_mates(args, experiment)
+        kept = sum(os.path.getsize(filepath) for filepath in written if os.path.isfile(filepath))
+    finally:
+        args.disk_budget.release(footprint, kept)
+    return experiment
+
+
+def download_mates(args, experiment):
+    """Downloads R1 and R2 mates. If any of them fails, removes combined files created for both"""
+    run_id = experiment["run_id"]
+    if args.paired:                                                            # removes both files itself
+        experiment["first_combined"], experiment["second_combined"] = download_paired_files(
+            experiment["first_files"], experiment["second_files"], run_id, args.rerun, args.counts, args.cache, args.spread,
+            compress_level=args.compress_level, compress_threads=args.compress_threads, delete_cached=args.delete_cached
+        )
+        return experiment
+    combined_filepaths = get_combined_filepaths(run_id)
+    existing = [filepath for filepath in combined_filepaths if os.path.isfile(filepath)]      # not ours to remove
+    try:
+        if args.jobs > 1:
+            with ThreadPoolExecutor(max_workers=2) as mates_executor:              # download R1 and R2 mates in parallel
+                first_future = mates_executor.submit(metrics.propagate(download_files), experiment["first_files"], run_id+"_R1", args.rerun, args.counts, args.cache,
+                                                  compress_level=args.compress_level, compress_threads=args.compress_threads, delete_cached=args.delete_cached)
+                second_future = mates_executor.submit(metrics.propagate(download_files), experiment["second_files"], run_id+"_R2", args.rerun, args.counts, args.cache,
+                                                  compress_level=args.compress_level, compress_threads=args.compress_threads, delete_cached=args.delete_cached)
+                experiment["first_combined"], experiment["second_combined"] = first_future.result(), second_future.result()
+        else:
+            experiment["first_combined"] = download_files(experiment["first_files"], run_id+"_R1", args.rerun, args.counts, args.cache,
+                                                  compress_level=args.compress_level, compress_threads=args.compress_threads, delete_cached=args.delete_cached)
+            experiment["second_combined"] = download_files(experiment["second_files"], run_id+"_R2", args.rerun, args.counts, args.cache,
+                                                  compress_level=args.compress_level, compress_threads=args.compress_threads, delete_cached=args.delete_cached)
+    except Exception:
+        remove_files([filepath for filepath in combined_filepaths if filepath not in existing])
+        raise
+    return experiment
+
+
+def count_experiment(args, experiment):
+    experiment["first_counts"] = get_reads_count(experiment["first_combined"], args.threads)
+    experiment["second_counts"] = get_reads_count(experiment["second_combined"], args.threads)
+    print("\n  Reads count:", experiment["run_id"], experiment["first_counts"], experiment["second_counts"])
+    return experiment
+
+
+def trigger_experiments(args, experiments):
+    """
+    Triggers all experiments of the batch at once. Returns experiment or error for each of them.
+    Trigger time is split evenly between the experiments of the batch in their metrics
+    """
+    jobs = []
+    for experiment in experiments:
+        job_template = get_job_template(args, experiment["run_id"], experiment["first_combined"], experiment["second_combined"])
+        print(dumps(job_template, indent = 4))
+        jobs.append((experiment["run_id"], job_template))
+    if args.download:
+        return experiments
+    start = time.perf_counter()
+    try:
+        failed = trigger_jobs(jobs, args.dag, args.suffix, args.trigger_backend, args.airflow_url, args.trigger_folder)
+    except Exception as err:
+        failed = {run_id: err for run_id, _ in jobs}
+    seconds = (time.perf_counter() - start) / len(jobs)
+    for run_id, _ in jobs:
+        metrics.add("trigger_dag", run_id, seconds=seconds, calls=1, failures=int(run_id in failed))
+    return [failed.get(experiment["run_id"], experiment) for experiment in experiments]
+
+
+def get_run_id(exp_idx):
+    return "_".join([str(i) for i in exp_idx]) if isinstance(exp_idx, tuple) else exp_idx
+
+
+def restore_stage(args, name, experiment):
+    """Returns True if the stage was finished in the previous run and restores its results from the state database"""
+    stage = STAGE_STATES[name]
+    if not args.state or stage == STATES[0]:                                   # pairing is cheap and its results are not saved
+        return False
+    state = get_state(args.state, experiment["run_id"], args.suffix)
+    if not state or not is_reached(state["stage"], stage):
+        return False
+    print(f"""\n  Skip {name} stage of {experiment["run_id"]}. Already {state["stage"]}""")
+    experiment.update({key: state[key] for key in FIELDS if state[key] is not None})
+    return True
+
+
+def run_stage(args, name, function, experiment):
+    """
+    Runs function collecting its metrics for the experiment, profiles it if requested.
+    With --state database skips the stage finished before and saves reached stage or error
+    """
+    run_id = get_run_id(experiment["exp_idx"])
+    experiment["run_id"] = run_id
+    if restore_stage(args, name, experiment):
+        return experiment
+    with metrics.experiment(run_id, run_id == args.profile):
         try:
-            print("\n  SRR: ", srr_files)
-            run_id = exp_idx
-            first_combined, second_combined = extract_sra(srr_files, run_id, args.fdump, args.local, args.rerun)
-            job_template = {
-                "job": {
-                    "fastq_file_1": {
-                        "class": "File",
-                        "location": first_combined
-                    },
-                    "fastq_file_2": {
-                        "class": "File",
-                        "location": second_combined
-                    },
-                    "indices_folder": {
-                        "class": "Directory",
-                        "location": args.indices
-                    },
-                    "blacklisted_regions_bed": {
-                        "class": "File",
-                        "location": args.blacklisted
-                    },
-                    "genome_fasta_file": {
-                        "class": "File",
-                        "location": args.genome
-                    },
-                    "genome_size": "2.7e9",
-                    "outputs_folder": os.path.join(args.output, run_id),
-                    "threads": args.threads
-                }
-            }
-            print(dumps(job_template, indent = 4))
-            if not args.download:
-                trigger_dag(job_template, run_id, args.dag, args.suffix)
+            experiment = function(args, experiment)
         except Exception as err:
-            print("\n  Failed to submit job:", err)
+            save_stage(args, name, experiment, err)
+            raise
+    save_stage(args, name, experiment, experiment)
+    return experiment
+
+
+def run_batch_stage(args, name, function, experiments):
+    """Runs function for the batch of experiments. With --state database saves reached stage or error of each of them"""
+    for experiment in experiments:
+        experiment["run_id"] = get_run_id(experiment["exp_idx"])
+    try:
+        results = function(args, experiments)
+    except Exception as err:
+        results = [err] * len(experiments)
+    for experiment, result in zip(experiments, results):
+        save_stage(args, name, experiment, result)
+    return results
+
+
+def save_stage(args, name, experiment, result):
+    """Saves stage reached by the experiment or error from result to --state database"""
+    if not args.state or (name == "trigger" and args.download):               # nothing is triggered, keep it for the next run
+        return
+    if isinstance(result, Exception):
+        set_error(args.state, experiment["run_id"], args.suffix, name, result)
+    else:
+        set_state(args.state, experiment["run_id"], args.suffix, STAGE_STATES[name], **{key: result.get(key) for key in FIELDS})
+
+
+def run_experiments(args, experiments, stages):
+    """
+    Passes at most args.number experiments through stages connected by bounded queues,
+    so downloading of the next experiments overlaps with counting and triggering of
+    the previous ones. Failed experiments don't interrupt processing of the others.
+    Experiments triggered according to --state database are skipped
+    """
+    finished = get_finished(args.state, args.suffix) if args.state else set()
+    experiments = islice(
+        (experiment for experiment in experiments if get_run_id(experiment["exp_idx"]) not in finished),
+        args.number or None
+    )
+    if finished:
+        print(f"""Skip {len(finished)} experiment(s) already triggered""")
+    succeeded, failed = run_pipeline(
+        experiments,
+        [
+            (name, partial(run_batch_stage, args, name, function), workers, batch_size[0]) if batch_size
+            else (name, partial(run_stage, args, name, function), workers)
+            for name, function, workers, *batch_size in stages
+        ]
+    )
+    print(f"""\n\n\nProcessed {len(succeeded) + len(failed)} experiment(s): {len(succeeded)} succeeded, {len(failed)} failed""")
+    for experiment, stage, err in failed:
+        print("  Failed -", experiment["exp_idx"], "at", stage, "stage:", err)
+    return succeeded, failed
+
+
+def print_status(connection, suffix):
+    counts, failed = get_status(connection, suffix)
+    print(f"""Experiments with suffix "{suffix}": {sum(counts.values())}""")
+    for stage in STATES + ["none"]:
+        if stage in counts:
+            print(f"""  {stage:<12}{counts[stage]}""")
+    print(f"""  failed      {len(failed)}""")
+    for run_id, _, stage, error in failed:
+        print("  Failed -", run_id, "at", stage, "stage:", error)
+
+
+def submit_jobs_sra (args, metadata):
+    experiments = (
+        {"exp_idx": exp_idx, "exp_data": exp_data}
+        for exp_idx, exp_data in metadata.groupby(level=EXP_COLUMNS_SRA)
+    )
+    return run_experiments(args, experiments, [
+        ("prepare", prepare_sra_experiment, 1),
+        ("extract", extract_sra_experiment, args.jobs),
+        ("count",   count_experiment,       args.count_jobs),
+        ("trigger", trigger_experiments,    args.trigger_jobs, args.trigger_batch)
+    ])
 
 
 def submit_jobs (args, metadata):
-    count = 0
-    for exp_idx, exp_data in metadata.groupby(level=EXP_COLUMNS):
-        if args.number and count >= args.number:
-            break
-        print("\n\n\nProcess experiment:\n\n  Experiment accession -", exp_idx[0],"\n  Biological replicate -", exp_idx[1])
-        first_files = exp_data.loc[exp_idx+(1,)]
-        second_files = exp_data.loc[exp_idx+(2,)]
-        count = count + 1
-        try:
-            second_files = get_properly_paired_second_files(first_files, second_files)
-            print("\n  First:\n", first_files[["File accession", "Paired with"]])
-            print("\n  Second:\n", second_files[["File accession", "Paired with"]])
-            run_id = "_".join([str(i) for i in exp_idx])
-            first_combined = download_files(first_files, run_id+"_R1", args.rerun, args.counts)
-            second_combined = download_files(second_files, run_id+"_R2", args.rerun, args.counts)
-            job_template = {
-                "job": {
-                    "fastq_file_1": {
-                        "class": "File",
-                        "location": first_combined
-                    },
-                    "fastq_file_2": {
-                        "class": "File",
-                        "location": second_combined
-                    },
-                    "indices_folder": {
-                        "class": "Directory",
-                        "location": args.indices
-                    },
-                    "blacklisted_regions_bed": {
-                        "class": "File",
-                        "location": args.blacklisted
-                    },
-                    "genome_fasta_file": {
-                        "class": "File",
-                        "location": args.genome
-                    },
-                    "genome_size": "2.7e9",
-                    "outputs_folder": os.path.join(args.output, run_id),
-                    "threads": args.threads
-                }
-            }
-            print(dumps(job_template, indent = 4))
-            if not args.download:
-                trigger_dag(job_template, run_id, args.dag, args.suffix)
-        except Exception as err:
-            print("\n  Failed to submit job:", err)
+    first_files, second_files = validate_pairing(args, metadata)
+    if args.validate:
+        return [], []
+    experiments = (
+        {"exp_idx": exp_idx, "first_files": first_pair, "second_files": second_pair}
+        for exp_idx, first_pair, second_pair in iter_pairs(first_files, second_files, EXP_COLUMNS)
+    )
+    return run_experiments(args, experiments, [
+        ("pair",     pair_experiment,     1),
+        ("download", download_experiment, args.jobs),
+        ("count",    count_experiment,    args.count_jobs),
+        ("trigger",  trigger_experiments, args.trigger_jobs, args.trigger_batch)
+    ])
 
 
 def main(argsl=None):
     if argsl is None:
         argsl = sys.argv[1:]
-    args,_ = arg_parser().parse_known_args(argsl)
-    args = normalize_args(args, ["dag", "number", "sra", "local", "rerun", "threads", "counts", "download", "suffix"])
+    general_parser = arg_parser()
+    args,_ = general_parser.parse_known_args(argsl)
+    missing = [f"""--{name}""" for name in REQUIRED_ARGS if not getattr(args, name)]
+    if args.status and not args.state:
+        general_parser.error("""--status requires --state database""")
+    elif not args.status and missing:
+        general_parser.error(f"""the following arguments are required: {", ".join(missing)}""")
+    args = normalize_args(args, ["dag", "number", "sra", "local", "rerun", "threads", "counts", "download", "suffix", "jobs", "count_jobs", "sra_jobs", "trigger_jobs", "trigger_batch", "paired", "spread", "compress_level", "compress_threads", "disk_budget", "bandwidth", "delete_cached", "trigger_backend", "airflow_url", "validate", "status", "profile"])
+    if args.status:
+        print_status(open_state(args.state), args.suffix)
+        return
+    args.cache = get_cache_folder(args.cache)
+    args.compress_threads = args.compress_threads or args.threads
+    args.disk_budget = DiskBudget(CWD, parse_size(args.disk_budget) if args.disk_budget else None)
+    set_bandwidth(parse_size(args.bandwidth) if args.bandwidth else None)
+    args.state = open_state(args.state) if args.state else None
     if args.sra:
-        metadata = get_metadata_sra(args.metadata)
+        metadata = get_metadata_sra(args.metadata, args.cache)
         submit_jobs_sra(args, metadata)
     else:
-        metadata = get_metadata(args.metadata)
+        metadata = get_metadata(args.metadata, args.cache)
         submit_jobs(args, metadata)
+    if args.report:
+        metrics.export_report(args.report)
+        print("\nExport report to file:\n", args.report)
+    if args.prom:
+        metrics.export_prometheus(args.prom)
+    if args.profile:
+        print("\nExport profiles to files:\n", metrics.export_profiles(CWD))
 
 
 if __name__ == "__main__":
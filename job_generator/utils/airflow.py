@@ -0,0 +1,113 @@
+import os
+import time
+import base64
+import threading
+import subprocess
+from json import dumps
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import urlsplit, quote
+from job_generator.utils.utils import export_to_file
+
+
+TRIGGER_BACKENDS = ["cli", "rest", "file"]
+AIRFLOW_URL_ENV = "AIRFLOW_URL"
+AIRFLOW_USERNAME_ENV = "AIRFLOW_USERNAME"
+AIRFLOW_PASSWORD_ENV = "AIRFLOW_PASSWORD"
+AIRFLOW_URL = "http://localhost:8080"
+TIMEOUT = 60
+RETRIES = 5
+BACKOFF = 2
+SESSION = threading.local()                                            # keeps HTTP connections per thread
+
+
+def get_airflow_url(url=None):
+    return url or os.environ.get(AIRFLOW_URL_ENV, AIRFLOW_URL)
+
+
+def get_connection(url):
+    """Returns HTTP(S) connection to the host of url reused by the current thread"""
+    parts = urlsplit(url)
+    connections = SESSION.__dict__.setdefault("connections", {})
+    if (parts.scheme, parts.netloc) not in connections:
+        connection_class = HTTPSConnection if parts.scheme == "https" else HTTPConnection
+        connections[(parts.scheme, parts.netloc)] = connection_class(parts.netloc, timeout=TIMEOUT)
+    return connections[(parts.scheme, parts.netloc)]
+
+
+def post_json(url, data, headers, retries=RETRIES):
+    """
+    Sends data to url through the pooled connection. Connection errors, 429 and 5xx
+    responses are retried with exponential backoff. Returns status and response body
+    """
+    error = None
+    for attempt in range(retries):
+        connection = get_connection(url)
+        try:
+            connection.request("POST", urlsplit(url).path, body=dumps(data), headers=headers)
+            response = connection.getresponse()
+            body = response.read().decode("utf-8", errors="replace")
+            if response.status != 429 and response.status < 500:
+                return response.status, body
+            error = f"""HTTP {response.status} {body}"""
+        except (HTTPException, OSError) as err:
+            connection.close()                                         # reconnects on the next request
+            error = err
+        if attempt < retries - 1:
+            print(f"""  Failed to POST {url} ({error}). Retry in {BACKOFF ** attempt} s""")
+            time.sleep(BACKOFF ** attempt)
+    raise Exception(f"""Failed to POST {url}: {error}""")
+
+
+def trigger_cli(runs, dag_id):
+    failed = {}
+    for run_id, job in runs:
+        params = ["airflow", "trigger_dag", "-r", run_id, "-c", dumps(job), dag_id]
+        print("Trigger dag", params)
+        try:
+            subprocess.run(params, env=os.environ.copy(), check=True)
+        except Exception as err:
+            failed[run_id] = err
+    return failed
+
+
+def trigger_rest(runs, dag_id, url):
+    endpoint = get_airflow_url(url).rstrip("/") + f"""/api/v1/dags/{quote(dag_id)}/dagRuns"""
+    headers = {"Content-Type": "application/json", "Accept": "application/json"}
+    if os.environ.get(AIRFLOW_USERNAME_ENV):
+        credentials = f"""{os.environ[AIRFLOW_USERNAME_ENV]}:{os.environ.get(AIRFLOW_PASSWORD_ENV, "")}"""
+        headers["Authorization"] = "Basic " + base64.b64encode(credentials.encode()).decode()
+    failed = {}
+    for run_id, job in runs:
+        print("Trigger dag", dag_id, "with run id", run_id, "through", endpoint)
+        try:
+            status, body = post_json(endpoint, {"dag_run_id": run_id, "conf": job}, headers)
+            if status >= 300:
+                raise Exception(f"""HTTP {status} {body}""")
+        except Exception as err:
+            failed[run_id] = err
+    return failed
+
+
+def trigger_file(runs, dag_id, folder):
+    failed = {}
+    for run_id, job in runs:
+        filename = os.path.join(folder or os.getcwd(), run_id + ".json")
+        print("Export dag run to", filename)
+        try:
+            export_to_file(dumps({"dag_id": dag_id, "run_id": run_id, "conf": job}, indent=4), filename)
+        except Exception as err:
+            failed[run_id] = err
+    return failed
+
+
+def trigger_dags(runs, dag_id, backend="cli", url=None, folder=None):
+    """
+    Triggers dag_id for all (run_id, job) from runs with the selected backend:
+    cli - airflow trigger_dag, rest - Airflow REST API, file - job files saved to folder.
+    Returns {run_id: error} for failed runs
+    """
+    if backend == "rest":
+        return trigger_rest(runs, dag_id, url)
+    elif backend == "file":
+        return trigger_file(runs, dag_id, folder)
+    return trigger_cli(runs, dag_id)
@@ -0,0 +1,77 @@
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+BLOCK_SIZE = 4 * 1024 * 1024
+GZIP_WBITS = zlib.MAX_WBITS | 16
+
+
+def compress_block(data, level):
+    """Returns data compressed as a standalone gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter:
+    """
+    File-like object that writes standard multi-member gzip. Data is split into blocks
+    compressed independently in a thread pool and written in the original order.
+    The number of blocks in flight is limited, so memory usage doesn't depend on file size
+    """
+
+    def __init__(self, filename, mode="wb", level=6, threads=1, block_size=BLOCK_SIZE):
+        self.output_stream = open(filename, mode)
+        self.level = level
+        self.block_size = block_size
+        self.max_pending = 2 * threads
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self.submit_block()
+        return len(data)
+
+    def submit_block(self):
+        if not self.buffered:
+            return
+        data = b"".join(self.buffer)
+        self.buffer, self.buffered = [], 0
+        if self.executor:
+            self.pending.append(self.executor.submit(compress_block, data, self.level))
+            while len(self.pending) > self.max_pending:
+                self.output_stream.write(self.pending.popleft().result())
+        else:
+            self.output_stream.write(compress_block(data, self.level))
+
+    def flush(self):
+        self.submit_block()
+        while self.pending:
+            self.output_stream.write(self.pending.popleft().result())
+        self.output_stream.flush()
+
+    def write_compressed(self, data):
+        """Writes already gzip compressed data after everything written before"""
+        self.flush()
+        self.output_stream.write(data)
+
+    def close(self):
+        if self.output_stream.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            if self.executor:
+                self.executor.shutdown()
+            self.output_stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,65 @@
+import os
+import time
+from http.client import HTTPException, IncompleteRead
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+from job_generator.utils.utils import get_folder, get_checksum
+from job_generator.utils.scheduler import throttle
+
+
+CHUNK_SIZE = 1024 * 1024
+RETRIES = 5
+BACKOFF = 2
+
+
+def get_cached_filepath(cache_folder, url, accession, md5sum=None):
+    """Returns location of the file in the cache folder named by accession and md5sum"""
+    extension = url.split("/")[-1].partition(".")[2]                   # fastq.gz
+    basename = ".".join([str(i) for i in [accession, md5sum, extension] if i])
+    return os.path.join(get_folder(os.path.join(cache_folder, "encode")), basename)
+
+
+def fetch_range(url, partial_filepath, chunk_size=CHUNK_SIZE):
+    """Appends to partial_filepath the rest of url content. Starts from scratch if server doesn't support ranges"""
+    offset = os.path.getsize(partial_filepath) if os.path.isfile(partial_filepath) else 0
+    request = Request(url, headers={"Range": f"""bytes={offset}-"""} if offset else {})
+    try:
+        with urlopen(request) as response:
+            if offset and response.status != 206:
+                print(f"""  Server ignored range request, restart download of {url}""")
+                offset = 0
+            with open(partial_filepath, "ab" if offset else "wb") as output_stream:
+                for chunk in iter(lambda: response.read(chunk_size), b""):
+                    throttle(len(chunk))
+                    output_stream.write(chunk)
+            if getattr(response, "length", None):                          # connection was closed too early
+                raise IncompleteRead(b"", response.length)
+    except HTTPError as err:
+        if err.code != 416 or not offset:                             # 416 - partial file is already complete
+            raise
+
+
+def fetch_file(url, filepath, md5sum=None, retries=RETRIES):
+    """
+    Downloads url to filepath through filepath.part resuming interrupted transfers
+    with HTTP Range requests. Downloaded file is checked against md5sum if it's set
+    """
+    if os.path.isfile(filepath):
+        print("\n  Use cached", filepath)
+        return filepath
+    partial_filepath = filepath + ".part"
+    print("\n  Download", url, "to", filepath)
+    for attempt in range(retries):
+        try:
+            fetch_range(url, partial_filepath)
+            break
+        except (URLError, HTTPException, ConnectionError, TimeoutError) as err:
+            if isinstance(err, HTTPError) and err.code < 500 or attempt == retries - 1:
+                raise
+            print(f"""  Failed to download {url} ({err}). Resume in {BACKOFF ** attempt} s""")
+            time.sleep(BACKOFF ** attempt)
+    if md5sum and get_checksum(partial_filepath) != md5sum:
+        os.remove(partial_filepath)
+        raise Exception(f"""File {url} doesn't match md5sum {md5sum}""")
+    os.replace(partial_filepath, filepath)
+    return filepath
@@ -0,0 +1,278 @@
+import os
+import zlib
+import mmap
+import threading
+from json import load, dump
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+from job_generator.utils import metrics
+from job_generator.utils.scheduler import ThrottledReader
+
+
+CHUNK_SIZE = 1024 * 1024
+COUNT_CHUNK_SIZE = 16 * 1024 * 1024
+LINES_PER_READ = 4
+GZIP_WBITS = zlib.MAX_WBITS | 16
+GZIP_MAGIC = b"\x1f\x8b\x08"
+READS_CACHE_FILENAME = ".read_counts.json"
+READS_CACHE_LOCK = threading.Lock()
+
+
+def open_location(location):
+    """Opens local file or URL for binary reading"""
+    if os.path.isfile(location):
+        return open(location, "rb")
+    return ThrottledReader(urlopen(location))
+
+
+def iter_decompressed(input_stream, chunk_size=CHUNK_SIZE):
+    """Yields decompressed data blocks from gzip stream. Multi-member gzip is supported"""
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    started = False
+    while True:
+        chunk = input_stream.read(chunk_size)
+        if not chunk:
+            break
+        metrics.add(bytes=len(chunk))
+        while chunk:
+            started = True
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if decompressor.eof:                                   # next member may start in the same chunk
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                started = False
+            else:
+                chunk = b""
+    if started and not decompressor.eof:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+
+def copy_reads(blocks, output_stream, max_reads):
+    """
+    Writes to output_stream decompressed FASTQ blocks until max_reads reads are written.
+    Returns the number of written reads
+    """
+    max_lines = LINES_PER_READ * max_reads
+    lines = 0
+    last_byte = b"\n"
+    for block in blocks:
+        block_lines = block.count(b"\n")
+        if lines + block_lines >= max_lines:                       # limit is reached within current block
+            position = -1
+            for _ in range(max_lines - lines):
+                position = block.index(b"\n", position + 1)
+            output_stream.write(block[:position + 1])
+            return max_reads
+        output_stream.write(block)
+        lines += block_lines
+        last_byte = block[-1:]
+    if last_byte != b"\n":                                         # last line without trailing new line
+        output_stream.write(b"\n")
+        lines += 1
+    return lines // LINES_PER_READ
+
+
+def iter_lines(blocks):
+    """Yields lists of complete lines from decompressed data blocks"""
+    tail = b""
+    for block in blocks:
+        lines = (tail + block).split(b"\n")
+        tail = lines.pop()
+        if lines:
+            yield lines
+    if tail:
+        yield [tail]
+
+
+def fill_buffer(buffer, lines):
+    """Extends buffer from lines until it has at least one read. Returns False if lines are exhausted"""
+    while len(buffer) < LINES_PER_READ:
+        block = next(lines, None)
+        if block is None:
+            return False
+        buffer.extend(block)
+    return True
+
+
+def get_read_names(headers, strip_mate=False):
+    names = [header.split(None, 1)[:1] for header in headers]
+    if strip_mate:
+        names = [[name[0][:-2]] if name and name[0][-2:] in (b"/1", b"/2") else name for name in names]
+    return names
+
+
+def check_read_names(first_headers, second_headers, position):
+    """Fails if read names of mates don't match. Names are compared up to the first whitespace ignoring /1 and /2"""
+    first_names, second_names = get_read_names(first_headers), get_read_names(second_headers)
+    if first_names != second_names:
+        first_names, second_names = get_read_names(first_headers, True), get_read_names(second_headers, True)
+        for i, (first_name, second_name) in enumerate(zip(first_names, second_names)):
+            if first_name != second_name:
+                raise Exception(f"""Read {position + i + 1} is not paired: {first_headers[i]} and {second_headers[i]}""")
+
+
+def copy_paired_reads(first_blocks, second_blocks, first_stream, second_stream, max_reads):
+    """
+    Writes to first_stream and second_stream the same number of reads from decompressed R1 and R2
+    FASTQ blocks read side by side until max_reads pairs are written. Fails if mates are not paired
+    or if one of them has less reads. Returns the number of written pairs
+    """
+    first_lines, second_lines = iter_lines(first_blocks), iter_lines(second_blocks)
+    first_buffer, second_buffer = [], []
+    written = 0
+    while written < max_reads:
+        first_filled, second_filled = fill_buffer(first_buffer, first_lines), fill_buffer(second_buffer, second_lines)
+        if not first_filled or not second_filled:
+            if first_filled != second_filled:
+                raise Exception(f"""Mates have different numbers of reads, the shorter one ends after {written} reads""")
+            break
+        reads = min(len(first_buffer) // LINES_PER_READ, len(second_buffer) // LINES_PER_READ, max_reads - written)
+        size = reads * LINES_PER_READ
+        check_read_names(first_buffer[0:size:LINES_PER_READ], second_buffer[0:size:LINES_PER_READ], written)
+        first_stream.write(b"\n".join(first_buffer[:size]) + b"\n")
+        second_stream.write(b"\n".join(second_buffer[:size]) + b"\n")
+        del first_buffer[:size]
+        del second_buffer[:size]
+        written += reads
+    return written
+
+
+def count_lines(blocks):
+    """Counts lines in decompressed data blocks. Last line without trailing new line is counted too"""
+    lines = 0
+    last_byte = b"\n"
+    for block in blocks:
+        lines += block.count(b"\n")
+        last_byte = block[-1:]
+    return lines + (last_byte != b"\n"), last_byte
+
+
+def get_member_offsets(filename, parts):
+    """
+    Returns offsets that split gzip file into at most parts ranges, each starting
+    with something that looks like a gzip member header. Offsets are not guaranteed
+    to be real member boundaries, so they need to be validated when decompressing
+    """
+    offsets = [0]
+    size = os.path.getsize(filename)
+    if size == 0:
+        return offsets, size
+    with open(filename, "rb") as input_stream:
+        with mmap.mmap(input_stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for part in range(1, parts):
+                position = data.find(GZIP_MAGIC, max(offsets[-1] + 1, size * part // parts))
+                while position != -1 and position + 3 < size and data[position + 3] >= 0x20:   # reserved FLG bits must be zero
+                    position = data.find(GZIP_MAGIC, position + 1)
+                if position == -1:
+                    break
+                offsets.append(position)
+    return offsets, size
+
+
+def count_range_lines(filename, start, end):
+    """
+    Counts lines in gzip members located exactly within [start, end) bytes of filename.
+    Returns None if the range doesn't consist of complete gzip members
+    """
+    lines = 0
+    last_byte = b"\n"
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    started = False
+    with open(filename, "rb") as input_stream:
+        input_stream.seek(start)
+        remaining = end - start
+        try:
+            while remaining > 0:
+                chunk = input_stream.read(min(COUNT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    return None
+                remaining -= len(chunk)
+                while chunk:
+                    started = True
+                    data = decompressor.decompress(chunk)
+                    if data:
+                        lines += data.count(b"\n")
+                        last_byte = data[-1:]
+                    if decompressor.eof:
+                        chunk = decompressor.unused_data
+                        decompressor = zlib.decompressobj(GZIP_WBITS)
+                        started = False
+                    else:
+                        chunk = b""
+        except zlib.error:
+            return None
+    if started or start == end:                                    # the last member crosses the end of the range
+        return None
+    return lines, last_byte
+
+
+def count_lines_parallel(filename, threads):
+    """
+    Counts lines of multi-member gzip file decompressing independent members with
+    threads workers. Falls back to a single-threaded count if members can't be found
+    """
+    offsets, size = get_member_offsets(filename, threads)
+    if len(offsets) > 1:
+        ranges = list(zip(offsets, offsets[1:] + [size]))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(lambda r: count_range_lines(filename, *r), ranges))
+        if all(results):
+            metrics.add(bytes=size)
+            lines = sum(result[0] for result in results)
+            return lines + (results[-1][1] != b"\n")
+    with open(filename, "rb") as input_stream:
+        return count_lines(iter_decompressed(input_stream, COUNT_CHUNK_SIZE))[0]
+
+
+def get_cache_key(filename):
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def load_reads_cache(cache_filename):
+    try:
+        with open(cache_filename, "r") as input_stream:
+            return load(input_stream)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_cached_reads_count(filename):
+    """Returns reads count from the sidecar cache if filename's size and mtime didn't change"""
+    filename = os.path.abspath(filename)
+    cache_filename = os.path.join(os.path.dirname(filename), READS_CACHE_FILENAME)
+    with READS_CACHE_LOCK:
+        entry = load_reads_cache(cache_filename).get(os.path.basename(filename))
+    if entry and {"size": entry.get("size"), "mtime": entry.get("mtime")} == get_cache_key(filename):
+        return entry["reads"]
+    return None
+
+
+def set_cached_reads_count(filename, reads):
+    """Saves reads count to the sidecar cache located in the same folder as filename"""
+    filename = os.path.abspath(filename)
+    cache_filename = os.path.join(os.path.dirname(filename), READS_CACHE_FILENAME)
+    entry = dict(get_cache_key(filename), reads=reads)
+    with READS_CACHE_LOCK:
+        cache = load_reads_cache(cache_filename)
+        cache[os.path.basename(filename)] = entry
+        try:
+            temp_filename = f"""{cache_filename}.{os.getpid()}.tmp"""
+            with open(temp_filename, "w") as output_stream:
+                dump(cache, output_stream)
+            os.replace(temp_filename, cache_filename)
+        except OSError as err:
+            print("  Failed to update reads count cache:", err)
+
+
+@metrics.timed("get_reads_count")
+def get_reads_count(filename, threads=1):
+    """Returns the number of reads in gzip compressed FASTQ file. Cached in the sidecar file"""
+    reads = get_cached_reads_count(filename)
+    if reads is None:
+        reads = count_lines_parallel(filename, threads) // LINES_PER_READ
+        set_cached_reads_count(filename, reads)
+    metrics.add(reads=reads)
+    return reads
@@ -0,0 +1,46 @@
+import re
+
+
+def iter_literal_matches(samples, filelist):
+    """
+    Yields (sample, path) for every file which basename includes sample name as a substring.
+    All substrings of each basename with the lengths of sample names are looked up in a set,
+    so the whole listing is resolved in one pass
+    """
+    samples = set(samples)
+    lengths = sorted({len(sample) for sample in samples})
+    for filename, path in filelist.items():
+        for length in lengths:
+            substrings = {filename[i:i+length] for i in range(len(filename) - length + 1)}
+            for sample in substrings.intersection(samples):
+                yield sample, path
+
+
+def iter_regex_matches(samples, filelist):
+    """Yields (sample, path) for every file which basename matches sample name treated as a regular expression"""
+    patterns = [(sample, re.compile(sample)) for sample in set(samples)]
+    for filename, path in filelist.items():
+        for sample, pattern in patterns:
+            if pattern.search(filename):
+                yield sample, path
+
+
+def match_samples(samples, filelist, regex=False):
+    """
+    Returns {sample: sorted list of paths} for all samples. File is matched if its basename
+    (key of filelist) includes sample name. If regex is True sample names are used as regular expressions
+    """
+    samples = [str(sample) for sample in samples]
+    matches = {sample: [] for sample in samples}
+    for sample, path in (iter_regex_matches if regex else iter_literal_matches)(samples, filelist):
+        matches[sample].append(path)
+    for paths in matches.values():
+        paths.sort()
+    return matches
+
+
+def get_unresolved_samples(matches, expected=2):
+    """Returns lists of samples with less (missing) and more (ambiguous) than expected matched files"""
+    missing = [sample for sample, paths in matches.items() if len(paths) < expected]
+    ambiguous = [sample for sample, paths in matches.items() if len(paths) > expected]
+    return missing, ambiguous
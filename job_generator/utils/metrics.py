@@ -0,0 +1,129 @@
+import os
+import time
+import cProfile
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+from json import dumps
+
+
+RUN = "run"                                                            # experiment name for stages outside of experiments
+EXPERIMENT = contextvars.ContextVar("experiment", default=RUN)
+STAGE = contextvars.ContextVar("stage", default=None)
+LOCK = threading.Lock()
+METRICS = {}                                                           # {experiment: {stage: {metric: value}}}
+PROFILERS = {}                                                         # {experiment: cProfile.Profile}
+COUNTERS = ["calls", "failures", "seconds", "bytes", "reads"]
+
+
+def add(stage=None, experiment=None, **values):
+    """Adds values (seconds, bytes, reads, etc.) to the metrics of stage and experiment, current ones by default"""
+    stage = stage or STAGE.get()
+    if stage is None:
+        return
+    with LOCK:
+        entry = METRICS.setdefault(experiment or EXPERIMENT.get(), {}).setdefault(stage, dict.fromkeys(COUNTERS, 0))
+        for key, value in values.items():
+            entry[key] = entry.get(key, 0) + value
+
+
+def timed(stage):
+    """Decorator to record wall time, calls and failures of the function as stage"""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            token = STAGE.set(stage)
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                add(stage, seconds=time.perf_counter() - start, calls=1, failures=int(failed))
+                STAGE.reset(token)
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def experiment(name, profile=False):
+    """Attributes metrics recorded within the block to experiment name. Optionally profiles the block with cProfile"""
+    token = EXPERIMENT.set(name)
+    profiler = None
+    if profile:
+        with LOCK:
+            profiler = PROFILERS.setdefault(name, cProfile.Profile())
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        EXPERIMENT.reset(token)
+
+
+def propagate(function):
+    """Returns function that runs in a copy of the current context, so metrics of other threads keep experiment and stage"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+
+def get_rates(entry):
+    seconds = entry.get("seconds", 0)
+    return dict(
+        entry,
+        bytes_per_second=entry.get("bytes", 0) / seconds if seconds else 0,
+        reads_per_second=entry.get("reads", 0) / seconds if seconds else 0
+    )
+
+
+def get_report():
+    """Returns metrics per experiment and stage totals with throughput rates"""
+    with LOCK:
+        experiments = {name: {stage: dict(entry) for stage, entry in stages.items()} for name, stages in METRICS.items()}
+    totals = {}
+    for stages in experiments.values():
+        for stage, entry in stages.items():
+            total = totals.setdefault(stage, dict.fromkeys(COUNTERS, 0))
+            for key, value in entry.items():
+                total[key] = total.get(key, 0) + value
+    return {
+        "experiments": {name: {stage: get_rates(entry) for stage, entry in stages.items()} for name, stages in experiments.items()},
+        "stages": {stage: get_rates(entry) for stage, entry in totals.items()}
+    }
+
+
+def write_atomic(data, filename):
+    temp_filename = f"""{filename}.{os.getpid()}.tmp"""
+    with open(temp_filename, "w") as output_stream:
+        output_stream.write(data)
+    os.replace(temp_filename, filename)                                # textfile collector never sees partial file
+
+
+def export_report(filename):
+    write_atomic(dumps(get_report(), indent=4), filename)
+
+
+def export_prometheus(filename, prefix="job_generator"):
+    """Saves stage totals in Prometheus textfile collector format"""
+    lines = []
+    stages = get_report()["stages"]
+    for metric in COUNTERS:
+        name = f"""{prefix}_stage_{metric}_total"""
+        lines.extend([f"""# HELP {name} Total {metric} of the stage""", f"""# TYPE {name} counter"""])
+        lines.extend([f"""{name}{{stage="{stage}"}} {entry.get(metric, 0)}""" for stage, entry in sorted(stages.items())])
+    write_atomic("\n".join(lines) + "\n", filename)
+
+
+def export_profiles(folder):
+    """Saves collected cProfile stats as experiment.prof files. Returns their locations"""
+    locations = []
+    with LOCK:
+        for name, profiler in PROFILERS.items():
+            locations.append(os.path.join(folder, f"""{name}.prof"""))
+            profiler.dump_stats(locations[-1])
+    return locations
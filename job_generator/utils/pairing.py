@@ -0,0 +1,69 @@
+ACCESSION_COLUMN = "File accession"
+PAIRED_COLUMN = "Paired with"
+MATE_COLUMN = "Paired end"
+MATES = [1, 2]
+
+
+def get_work_plan(metadata, exp_columns, accession=ACCESSION_COLUMN, paired=PAIRED_COLUMN, mate=MATE_COLUMN):
+    """
+    Pairs files of all experiments from metadata at once. Each file should be referenced back by
+    the file from its "Paired with" column, that should be the other mate of the same experiment.
+    Accessions should be unique. Experiments with at least one broken file or with different numbers
+    of mates are rejected. Returns first and second mates of the accepted experiments as two
+    metadata frames aligned row by row and grouped by experiment, and the rejection report with
+    the number of broken files and the first reason per experiment
+    """
+    import numpy as np
+    import pandas as pd
+    table = metadata.reset_index()
+    positions = np.arange(len(table.index))
+    accessions = table[accession].astype(str).to_numpy(dtype=object)
+    partners = table[paired].fillna("").astype(str).to_numpy(dtype=object)
+    mates = table[mate].to_numpy()
+    experiments = table.groupby(exp_columns, sort=False, dropna=False).ngroup().to_numpy()
+    reasons = np.full(len(table.index), None, dtype=object)
+
+    def reject(mask, template, *columns):
+        for position in np.flatnonzero(mask & (reasons == None)):          # keep the first reason of each file
+            reasons[position] = template.format(*[column[position] for column in columns])
+
+    duplicated = table[accession].duplicated(keep=False).to_numpy()
+    lookup = pd.Series(positions[~duplicated], index=accessions[~duplicated])
+    partner_positions = pd.Series(partners).map(lookup).fillna(-1).astype(int).to_numpy()
+    found = partner_positions >= 0
+    partner_positions = np.where(found, partner_positions, positions)       # safe to index, masked by found
+
+    reject(~np.isin(mates, MATES), "File {} has unexpected " + mate + " {}", accessions, mates)
+    reject(duplicated, "File {} is duplicated", accessions)
+    reject(~found, "File {} is paired with missing {}", accessions, partners)
+    reject(
+        partners[partner_positions] != accessions,
+        "File {} is paired with {}, but {} is paired with {}", accessions, partners, partners, partners[partner_positions]
+    )
+    reject(experiments[partner_positions] != experiments, "File {} is paired with {} from another experiment", accessions, partners)
+    reject(mates[partner_positions] == mates, "Files {} and {} are the same mate", accessions, partners)
+    first_counts = np.bincount(experiments, weights=mates == MATES[0])[experiments].astype(int)
+    second_counts = np.bincount(experiments, weights=mates == MATES[1])[experiments].astype(int)
+    reject(first_counts != second_counts, "Experiment has {} first and {} second mates", first_counts, second_counts)
+
+    broken = reasons != None
+    rejected = table.loc[broken, exp_columns].assign(Reason=reasons[broken]).groupby(exp_columns, sort=False).agg(
+        Broken=("Reason", "size"),
+        Reason=("Reason", "first")
+    ).reset_index()
+    accepted = positions[~np.isin(experiments, experiments[broken]) & (mates == MATES[0])]
+    accepted = accepted[np.argsort(experiments[accepted], kind="stable")]     # rows of each experiment go together
+    return metadata.iloc[accepted], metadata.iloc[partner_positions[accepted]], rejected
+
+
+def iter_pairs(first_files, second_files, exp_columns, mate=MATE_COLUMN):
+    """Yields (experiment index, first mates, second mates) from the frames returned by get_work_plan"""
+    import numpy as np
+    experiments = first_files.groupby(level=exp_columns, sort=False).ngroup().to_numpy()
+    starts = np.flatnonzero(np.diff(experiments, prepend=-1))
+    ends = np.append(starts[1:], len(experiments))
+    keys = first_files.index.droplevel([level for level in first_files.index.names if level not in exp_columns]).tolist()
+    levels = exp_columns + [mate]
+    first_files, second_files = first_files.droplevel(levels), second_files.droplevel(levels)
+    for start, end in zip(starts, ends):
+        yield keys[start], first_files.iloc[start:end], second_files.iloc[start:end]
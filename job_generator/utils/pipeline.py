@@ -0,0 +1,93 @@
+import queue
+import threading
+
+
+STOP = object()
+
+
+def get_batch(input_queue, batch_size):
+    """Returns the next item with up to batch_size-1 more items already waiting in input_queue"""
+    items = [input_queue.get()]
+    while items[-1] is not STOP and len(items) < batch_size:
+        try:
+            items.append(input_queue.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+
+def run_stage(name, function, workers, input_queue, output_queue, next_workers, failed, lock, batch_size=None):
+    """
+    Starts workers that apply function to items from input_queue and put results to output_queue.
+    If batch_size is set, function gets a list of up to batch_size items waiting in the queue and
+    returns a list of results or exceptions in the same order. When all workers are stopped, sends
+    stop signal to each worker of the next stage
+    """
+
+    def process(items):
+        if batch_size:
+            try:
+                return list(zip(items, function(items)))
+            except Exception as err:
+                return [(item, err) for item in items]
+        try:
+            return [(items[0], function(items[0]))]
+        except Exception as err:
+            return [(items[0], err)]
+
+    def worker():
+        while True:
+            items = get_batch(input_queue, batch_size or 1)
+            stopped = items[-1] is STOP
+            if stopped:
+                items.pop()
+            for item, result in process(items) if items else []:
+                if isinstance(result, Exception):
+                    print(f"""\n  Failed at {name} stage: {result}""")
+                    with lock:
+                        failed.append((item, name, result))
+                else:
+                    output_queue.put(result)                           # blocks while the next stage is busy
+            if stopped:
+                break
+
+    def coordinator():
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for _ in range(next_workers):
+            output_queue.put(STOP)
+
+    thread = threading.Thread(target=coordinator, daemon=True)
+    thread.start()
+    return thread
+
+
+def run_pipeline(items, stages):
+    """
+    Passes items through stages, each defined as (name, function, workers) or (name, function,
+    workers, batch_size) for a stage that processes items in batches. Stages are connected by
+    queues bounded by the number of items the consuming stage can take at once, so a fast stage
+    waits for a slow one instead of piling up results. Item that failed at some stage is not
+    passed further. Returns results of the last stage and [(item, stage name, error)] for failed items
+    """
+    lock = threading.Lock()
+    failed = []
+    stages = [(name, function, workers, batch_size[0] if batch_size else None) for name, function, workers, *batch_size in stages]
+    queues = [queue.Queue(maxsize=workers * (batch_size or 1)) for _, _, workers, batch_size in stages] + [queue.Queue()]
+    threads = []
+    for index, (name, function, workers, batch_size) in enumerate(stages):
+        next_workers = stages[index+1][2] if index + 1 < len(stages) else 1
+        threads.append(run_stage(name, function, workers, queues[index], queues[index+1], next_workers, failed, lock, batch_size))
+    for item in items:
+        queues[0].put(item)
+    for _ in range(stages[0][2]):
+        queues[0].put(STOP)
+    results = []
+    for item in iter(queues[-1].get, STOP):
+        results.append(item)
+    for thread in threads:
+        thread.join()
+    return results, failed
@@ -0,0 +1,139 @@
+import re
+import time
+import shutil
+import threading
+
+
+SIZE_COLUMN = "Size"
+READS_COLUMN = "Read count"
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+BANDWIDTH = None                                                       # shared by all downloads, set by set_bandwidth
+
+
+def parse_size(value):
+    """Converts size like 500G, 20M or 1024 to bytes"""
+    match = re.fullmatch(r"""\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*""", str(value), re.IGNORECASE)
+    if not match:
+        raise Exception(f"""Cannot parse size {value}. Use number of bytes with optional K, M, G or T suffix""")
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+
+def estimate_footprint(files_df, max_counts, fetched=None, delete_cached=False, spread=False):
+    """
+    Returns the estimated numbers of bytes written to disk while reads are taken from files_df until
+    max_counts is reached, for the combined file and for the files fetched to the cache. Combined file
+    size is estimated from Size column in proportion to the reads taken from each file (all reads if
+    Read count column is missing). Fetched files are marked by True in fetched list, they are counted
+    in full, or only the largest of them if they are deleted right after streaming. Both are 0 if Size
+    column is missing
+    """
+    import numpy as np
+    if SIZE_COLUMN not in files_df:
+        return 0, 0
+    sizes = files_df[SIZE_COLUMN].fillna(0).to_numpy(dtype=float)
+    fractions = np.ones(len(sizes))
+    if READS_COLUMN in files_df and files_df[READS_COLUMN].notna().all():
+        reads = np.maximum(files_df[READS_COLUMN].to_numpy(dtype=float), 1)
+        if spread:                                                     # even share from each file
+            fractions = np.clip(max_counts / len(reads) / reads, 0, 1)
+        else:                                                          # the first files until max_counts
+            fractions = np.clip((max_counts - (np.cumsum(reads) - reads)) / reads, 0, 1)
+    fetched = sizes[(fractions > 0) & np.asarray(fetched, dtype=bool)] if fetched is not None else sizes[:0]
+    cached_footprint = (fetched.max() if len(fetched) else 0) if delete_cached else fetched.sum()
+    return int((sizes * fractions).sum()), int(cached_footprint)
+
+
+class DiskBudget:
+    """
+    Admits work to folder only while its estimated footprint fits both the budget (bytes written
+    by the run, unlimited if None) and the free space left after the running work is finished
+    """
+
+    def __init__(self, folder, budget=None):
+        self.folder = folder
+        self.budget = budget
+        self.used = 0                                                  # kept on disk by the finished work
+        self.reserved = 0                                              # estimated for the running work
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def fits(self, footprint):
+        if self.budget is not None and self.used + self.reserved + footprint > self.budget:
+            return False
+        return shutil.disk_usage(self.folder).free - self.reserved >= footprint
+
+    def acquire(self, footprint, name=""):
+        """Waits until footprint fits. Fails if it doesn't fit even when nothing else is running"""
+        with self.condition:
+            if not self.fits(footprint) and self.running:
+                print(f"""\n  Wait for disk space for {name}, {footprint} bytes required""")
+            while not self.fits(footprint):
+                if not self.running:
+                    raise Exception(f"""Not enough disk space for {name}: {footprint} bytes required, """
+                                    f"""{self.budget - self.used if self.budget is not None else "no"} bytes left in budget, """
+                                    f"""{shutil.disk_usage(self.folder).free} bytes free in {self.folder}""")
+                self.condition.wait()
+            self.reserved += footprint
+            self.running += 1
+
+    def release(self, footprint, kept=0):
+        """Replaces estimated footprint with kept bytes actually left on disk"""
+        with self.condition:
+            self.reserved -= footprint
+            self.running -= 1
+            self.used += kept
+            self.condition.notify_all()
+
+
+class TokenBucket:
+    """Limits the total rate of consumed bytes across threads"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Takes amount of tokens, sleeps while the debt is paid off if there were not enough of them"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class ThrottledReader:
+    """Wraps binary stream to keep reading from it within the shared bandwidth"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        throttle(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream.close()
+
+
+def set_bandwidth(rate):
+    """Limits total download rate to rate bytes per second. None removes the limit"""
+    global BANDWIDTH
+    BANDWIDTH = TokenBucket(rate) if rate else None
+
+
+def throttle(amount):
+    if BANDWIDTH and amount:
+        BANDWIDTH.consume(amount)
@@ -0,0 +1,95 @@
+import time
+import sqlite3
+import threading
+
+
+STATES = ["paired", "downloaded", "counted", "triggered"]              # in the order they are reached
+FIELDS = ["first_combined", "second_combined", "first_counts", "second_counts"]
+LOCK = threading.Lock()
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS experiments (
+        run_id          TEXT NOT NULL,
+        suffix          TEXT NOT NULL,
+        stage           TEXT,
+        first_combined  TEXT,
+        second_combined TEXT,
+        first_counts    INTEGER,
+        second_counts   INTEGER,
+        failed_stage    TEXT,
+        error           TEXT,
+        updated         REAL,
+        PRIMARY KEY (run_id, suffix)
+    )
+"""
+
+
+def open_state(filename):
+    """Returns connection to SQLite state database shared by all threads. Creates database if it doesn't exist"""
+    connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")                       # status can be read while the run is writing
+    connection.execute(SCHEMA)
+    return connection
+
+
+def get_state(connection, run_id, suffix=""):
+    """Returns state of the experiment as dict or None if it wasn't processed before"""
+    with LOCK:
+        row = connection.execute("SELECT * FROM experiments WHERE run_id = ? AND suffix = ?", (run_id, suffix)).fetchone()
+    return dict(row) if row else None
+
+
+def get_finished(connection, suffix="", stage="triggered"):
+    """Returns set of run ids that reached stage"""
+    stages = STATES[STATES.index(stage):]
+    with LOCK:
+        rows = connection.execute(
+            f"""SELECT run_id FROM experiments WHERE suffix = ? AND stage IN ({",".join("?" * len(stages))})""",
+            [suffix] + stages
+        ).fetchall()
+    return {row["run_id"] for row in rows}
+
+
+def is_reached(current, stage):
+    return current in STATES and STATES.index(current) >= STATES.index(stage)
+
+
+def set_state(connection, run_id, suffix, stage, **fields):
+    """Saves stage reached by the experiment and not None fields, clears previous error. Never moves stage back"""
+    fields = {key: value for key, value in fields.items() if key in FIELDS and value is not None}
+    columns = ["run_id", "suffix", "stage", "failed_stage", "error", "updated"] + list(fields)
+    with LOCK:
+        row = connection.execute("SELECT stage FROM experiments WHERE run_id = ? AND suffix = ?", (run_id, suffix)).fetchone()
+        if row and is_reached(row["stage"], stage):                    # pairing is repeated on restart
+            stage = row["stage"]
+        values = [run_id, suffix, stage, None, None, time.time()] + list(fields.values())
+        connection.execute(
+            f"""INSERT INTO experiments ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})
+                ON CONFLICT (run_id, suffix) DO UPDATE SET {", ".join(f"{i} = excluded.{i}" for i in columns[2:])}""",
+            values
+        )
+
+
+def set_error(connection, run_id, suffix, stage, error):
+    """Saves error of the failed stage keeping the last reached one"""
+    with LOCK:
+        connection.execute(
+            """INSERT INTO experiments (run_id, suffix, failed_stage, error, updated) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT (run_id, suffix) DO UPDATE SET failed_stage = excluded.failed_stage,
+                                                          error = excluded.error, updated = excluded.updated""",
+            (run_id, suffix, stage, str(error), time.time())
+        )
+
+
+def get_status(connection, suffix=None):
+    """Returns number of experiments per reached stage and [(run_id, suffix, failed stage, error)] for failed ones"""
+    condition, params = ("WHERE suffix = ?", [suffix]) if suffix is not None else ("", [])
+    with LOCK:
+        counts = connection.execute(
+            f"""SELECT COALESCE(stage, 'none') AS stage, COUNT(*) AS number FROM experiments {condition} GROUP BY 1""", params
+        ).fetchall()
+        failed = connection.execute(
+            f"""SELECT run_id, suffix, failed_stage, error FROM experiments
+                {condition} {"AND" if condition else "WHERE"} error IS NOT NULL ORDER BY run_id""", params
+        ).fetchall()
+    return {row["stage"]: row["number"] for row in counts}, [tuple(row) for row in failed]
@@ -1,16 +1,124 @@
 import os
 import re
 import argparse
+import csv
+import hashlib
+from json import load, dump
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from job_generator.utils import metrics
 
 
-def get_files(current_dir, filename_pattern=".*"):
-    """Files with the identical basenames are overwritten"""
-    files_dict = {}
-    for root, dirs, files in os.walk(current_dir):
-        files_dict.update(
-            {filename: os.path.join(root, filename) for filename in files if re.match(filename_pattern, filename)}
-        )
-    return files_dict
+CACHE_ENV = "JOB_GENERATOR_CACHE"
+SCAN_THREADS = 8
+NA_VALUES = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+             "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}                     # the same as in pandas
+
+
+def get_checksum(filepath, algorithm="md5", chunk_size=1024*1024):
+    checksum = hashlib.new(algorithm)
+    with open(filepath, "rb") as input_stream:
+        for chunk in iter(lambda: input_stream.read(chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def get_cache_folder(location=None):
+    """Returns absolute path to the cache folder from location or JOB_GENERATOR_CACHE. None if both are not set"""
+    location = location or os.environ.get(CACHE_ENV)
+    return get_folder(os.path.abspath(location)) if location else None
+
+
+def scan_folder(folder, cached=None):
+    """Returns [mtime, files, subfolders] of folder. Cached listing is reused if folder's mtime didn't change"""
+    mtime = os.stat(folder).st_mtime_ns
+    if cached and cached[0] == mtime:
+        return cached
+    files, subfolders = [], []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files.append(entry.name)
+            elif not entry.is_symlink():                                # the same as os.walk with followlinks=False
+                subfolders.append(entry.name)
+    return [mtime, files, subfolders]
+
+
+def load_listing(cache_file):
+    try:
+        with open(cache_file, "r") as input_stream:
+            return load(input_stream)
+    except (TypeError, OSError, ValueError):
+        return {}
+
+
+def save_listing(listing, cache_file):
+    try:
+        temp_file = f"""{cache_file}.{os.getpid()}.tmp"""
+        with open(temp_file, "w") as output_stream:
+            dump(listing, output_stream)
+        os.replace(temp_file, cache_file)
+    except OSError as err:
+        print("Failed to save listing cache:", err)
+
+
+def walk_folders(current_dir, skip_pattern=None, cache_file=None, threads=SCAN_THREADS):
+    """
+    Returns {folder: [mtime, files, subfolders]} for all folders of current_dir tree.
+    Subfolders which names match skip_pattern are not visited. If cache_file is set,
+    only folders with the changed mtime are listed again and the cache is saved only
+    if the listing changed
+    """
+    cache = load_listing(cache_file) if cache_file else {}
+    skip = re.compile(skip_pattern) if skip_pattern else None
+    listing = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {executor.submit(scan_folder, current_dir, cache.get(current_dir)): current_dir}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder = pending.pop(future)
+                try:
+                    listing[folder] = future.result()
+                except OSError:                                         # os.walk ignores errors by default
+                    continue
+                for name in listing[folder][2]:
+                    if skip and skip.match(name):
+                        continue
+                    subfolder = os.path.join(folder, name)
+                    pending[executor.submit(scan_folder, subfolder, cache.get(subfolder))] = subfolder
+    if cache_file and listing != cache:                                 # unchanged folders keep cached lists, compared by identity
+        save_listing(listing, cache_file)
+    return listing
+
+
+@metrics.timed("get_files")
+def get_files(current_dir, filename_pattern=".*", skip_pattern=None, cache_folder=None):
+    """
+    Returns {basename: path} for files which basenames match filename_pattern and
+    {basename: [paths]} for basenames found more than once. For collisions the first
+    path in sorted order is used. Listing is cached in cache_folder if it's set
+    """
+    cache_file = None
+    if cache_folder:
+        folder_hash = hashlib.sha1(os.path.abspath(current_dir).encode()).hexdigest()
+        cache_file = os.path.join(get_folder(os.path.join(cache_folder, "listings")), folder_hash + ".json")
+    pattern = re.compile(filename_pattern)
+    found = {}
+    for folder, (_, files, _) in walk_folders(current_dir, skip_pattern, cache_file).items():
+        for filename in files:
+            if pattern.match(filename):
+                found.setdefault(filename, []).append(os.path.join(folder, filename))
+    files_dict, collisions = {}, {}
+    for filename, paths in found.items():
+        paths.sort()
+        files_dict[filename] = paths[0]
+        if len(paths) > 1:
+            collisions[filename] = paths
+    return files_dict, collisions
 
 
 def normalize_args(args, skip_list=[]):
@@ -36,4 +144,38 @@ def get_folder(abs_path, permissions=0o0775, exist_ok=True):
 def export_to_file(data, filename):
     get_folder(os.path.dirname(filename))
     with open(filename, 'w') as output_stream:
-        output_stream.write(data)
\ No newline at end of file
+        output_stream.write(data)
+
+
+def convert_column(values):
+    """Converts column values to bool, int or float when all of them allow it. Missing values become NaN like in pandas"""
+    present = [value for value in values if value not in NA_VALUES]
+    if present and len(present) == len(values):
+        if all(value in ("True", "False") for value in values):
+            return [value == "True" for value in values]
+        try:
+            return [int(value) for value in values]
+        except ValueError:
+            pass
+    try:
+        return [float("nan") if value in NA_VALUES else float(value) for value in values]
+    except ValueError:
+        return [float("nan") if value in NA_VALUES else value for value in values]
+
+
+def read_table_dict(filename, comment="#"):
+    """
+    Pure Python replacement for pd.read_table(filename, index_col=0, comment=comment).to_dict(orient="index")
+    to be used for small TSV files when importing pandas takes longer than reading the file
+    """
+    with open(filename, "r", newline="") as input_stream:
+        lines = [line.split(comment, 1)[0].rstrip("\r\n") for line in input_stream]
+    rows = list(csv.reader([line for line in lines if line.strip()], delimiter="\t"))
+    if not rows:
+        return {}
+    header, rows = rows[0], rows[1:]
+    columns = [convert_column([row[i] if i < len(row) else "" for row in rows]) for i in range(len(header))]
+    index = columns[0]
+    if len(set(index)) != len(index):
+        raise ValueError(f"""Index of {filename} must be unique""")
+    return {key: {name: column[i] for name, column in zip(header[1:], columns[1:])} for i, key in enumerate(index)}